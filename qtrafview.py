@@ -5,15 +5,25 @@
 
 __all__ = [ 'QTrafView' ]
 
-import sqlite3
+import logging
 from os.path import join
+from array import array
+from queue import Queue
+from functools import lru_cache
+from contextlib import contextmanager
+from threading import Lock
 from PyQt4 import QtCore, QtGui
-from PyQt4.QtGui import QTableWidgetItem
-from settings import DEFAULT_WORKDIR
+from PyQt4.QtCore import Qt
+from utm5client import Storage, DIRECTIONS, TRAFFIC_TYPES, epoch_day, \
+    from_epoch_day
 
-dbfile = join(DEFAULT_WORKDIR, 'sqlite.db')
 ipath = join('share', '22')
 
+@lru_cache(maxsize=None)
+def icon(name):
+  """ QIcon from ipath, loaded once """
+  return QtGui.QIcon(join(ipath, name))
+
 class tvDateEdit(QtGui.QDateEdit):
   """ QDateEdit + QCalendar """
 
@@ -32,6 +42,9 @@ class tvDateEdit(QtGui.QDateEdit):
   def __str__(self):
     return self.date().toString("dd.MM.yyyy")
 
+  def day(self):
+    return epoch_day(self.date().toPyDate())
+
 class tvTimeEdit(QtGui.QTimeEdit):
 
   def __init__(self, parent=None, hour=-1):
@@ -47,68 +60,232 @@ class tvTimeEdit(QtGui.QTimeEdit):
   def __eq__(self, obj):
     return str(self) == str(obj)
 
-class tvTable(QtGui.QTableWidget):
+class tvQueryJob(QtCore.QRunnable):
+  """
+    target.select(conn, *args) run in the thread pool, the result (or the
+    exception raised) is sent by target.ready(generation, result)
+  """
+
+  def __init__(self, target, generation, *args):
+    super(tvQueryJob, self).__init__()
+    # kept by the target to be cancelled, so not deleted by the pool
+    self.setAutoDelete(False)
+    self.target = target
+    self.generation = generation
+    self.args = args
+    self.lock = Lock()
+    self.conn = None
+    self.cancelled = False
+
+  def cancel(self):
+    with self.lock:
+      self.cancelled = True
+      if self.conn is not None:
+        self.conn.interrupt()
+
+  def run(self):
+    try:
+      with self.target.parent.jobRead() as conn:
+        with self.lock:
+          if self.cancelled:
+            return
+          self.conn = conn
+        try:
+          result = self.target.select(conn, *self.args)
+        finally:
+          with self.lock:
+            self.conn = None
+    except Exception as e:
+      # interrupted by cancel()
+      if self.cancelled:
+        return
+      logging.exception('Traffic query failed')
+      result = e
+    if not self.cancelled:
+      self.target.ready.emit(self.generation, result)
+
+class tvTableModel(QtCore.QAbstractTableModel):
+  """
+    Traffic of the range by hours, or summed by SQL into the groups of
+    tvComboGroup, read from the storage by pages of `page` rows as the
+    view scrolls. Row 0 is the total.
+
+    Both directions are selected together, so switching the direction or
+    the unit only redraws the view.
+
+    A new query runs in the thread pool and the model is reset when it is
+    done; an unfinished older query is interrupted and its results, if
+    any, are dropped.
+  """
   labels = ('Дата', 'Время', 'Объем')
   backcolor = QtGui.QColor(227, 227, 227)
+  totalcolor = QtGui.QColor(244, 0, 0)
+  page = 256
 
-  def __init__(self, parent=None):
-    super(tvTable, self).__init__(parent)
-    self.parent = parent
-    self.sqlconn = None
-    self.curs = None
-    self.myclear()
+  where = " WHERE ttype = ? AND day BETWEEN ? AND ? AND hour BETWEEN ? AND ?"
+  columns = "sum(CASE direction WHEN {in} THEN amount ELSE 0 END) AS amountIn," \
+            "sum(CASE direction WHEN {out} THEN amount ELSE 0 END) AS amountOut" \
+            .format(**DIRECTIONS)
 
-  def myclear(self):
-    self.clear()
-    self.setRowCount(1)
-    self.setColumnCount(len(self.labels))
-    self.setHorizontalHeaderLabels(self.labels)
+  ready = QtCore.pyqtSignal(int, object)
 
-  def refresh(self, dateSE, timeSE):
-    if not self.sqlconn:
-      self.sqlconn = sqlite3.connect(dbfile)
-      self.curs = self.sqlconn.cursor()
+  def __init__(self, parent):
+    super(tvTableModel, self).__init__(parent)
+    self.parent = parent
+    self.params = None
+    self.group = 0
+    self.total = (0, 0)
+    self.generation = 0
+    self.job = None
+    self.clearRows()
+    self.ready.connect(self.__ready)
+
+  def clearRows(self):
+    # first and last day and first hour of the rows
+    self.days, self.lastDays, self.hours = array('l'), array('l'), array('b')
+    # indexed by DIRECTIONS
+    self.amounts = (array('Q'), array('Q'))
+    self.more = False
+
+  def direction(self):
+    return DIRECTIONS['in' if str(self.parent.comboTrafType) == '0' else 'out']
+
+  def redraw(self):
+    """ Show the cached rows in the current direction and unit """
+    self.dataChanged.emit(self.index(0, 0),
+        self.index(self.rowCount() - 1, self.columnCount() - 1))
+
+  def query(self, params, group=0):
+    """
+      params: (ttype, first day, last day, first hour, last hour)
+      group: index of tvComboGroup.items
+    """
+    if self.job is not None:
+      self.job.cancel()
+    self.generation += 1
+    self.job = tvQueryJob(self, self.generation, tuple(params), group)
+    QtCore.QThreadPool.globalInstance().start(self.job)
+
+  def select(self, conn, params, group):
+    """ Return total and the first page, may be called from any thread """
+    total = conn.execute("SELECT " + self.columns + " FROM amounts" +
+        self.where, params).fetchone()
+    return params, group, tuple(i or 0 for i in total), \
+        self.selectPage(conn, params, group)
+
+  def selectPage(self, conn, params, group, last=None):
+    """ Return page of rows after `last` (first day, last day, hour) """
+    # the day range is narrowed to keep the index range scan
+    ttype, dayS, dayE, hourS, hourE = params
+    expr = tvComboGroup.items[group][1]
+    q = "SELECT min(day),max(day),min(hour)," + self.columns + " FROM amounts"
+    q+= self.where
+    if expr is None:
+      day, hour = (last[0], last[2]) if last else (dayS, -1)
+      q+= " AND (day > ? OR hour > ?) GROUP BY day,hour ORDER BY day,hour"
+      args = (ttype, day, dayE, hourS, hourE, day, hour)
+    else:
+      # groups are whole ranges of days
+      q+= " GROUP BY {0} ORDER BY {0}".format(expr)
+      args = (ttype, last[1] + 1 if last else dayS, dayE, hourS, hourE)
+    return conn.execute(q + " LIMIT ?", args + (self.page,)).fetchall()
 
-    if not self.sqlconn or not self.curs:
+  def __ready(self, generation, result):
+    if generation != self.generation:
+      return
+    self.job = None
+    self.beginResetModel()
+    self.clearRows()
+    if isinstance(result, Exception):
+      # do not leave rows of the previous range
+      self.total = (0, 0)
+      self.parent.setWindowTitle("Ошибка чтения базы: {}".format(result))
+    else:
+      self.params, self.group, self.total, rows = result
+      self.appendRows(rows)
+    self.endResetModel()
+
+  def appendRows(self, rows):
+    for day, lastDay, hour, amountIn, amountOut in rows:
+      self.days.append(day)
+      self.lastDays.append(lastDay)
+      self.hours.append(hour)
+      self.amounts[0].append(amountIn)
+      self.amounts[1].append(amountOut)
+    self.more = len(rows) == self.page
+
+  def canFetchMore(self, parent):
+    return not parent.isValid() and self.more
+
+  def fetchMore(self, parent):
+    if parent.isValid() or not self.more:
       return
 
-    ttype = "amounts_in" if str(self.parent.comboTrafType) == '0' else "amounts_out"
-    q = "SELECT date,hour,amount FROM '{}' WHERE date > '{}'"
-    q+= " AND date < '{}' AND hour > '{}' AND hour < '{}'"
-    q = q.format(ttype, dateSE[0], dateSE[1], timeSE[0], timeSE[1])
-    self.curs.execute(q)
-    #print("debug", ttype, q)
-
-    irow = 1
-    fullsum = 0
-    self.myclear()
-    for row in self.curs:
-      self.setRowCount(irow + 1)
-      fullsum += row[2]
-      d = QTableWidgetItem(str(row[0]))
-      h = QTableWidgetItem("{:02}:00".format(row[1]))
-
-      s = QTableWidgetItem(self.parent.comboTrafSize.calc(row[2]))
-      i = self.parent.comboTrafType.items[int(str(self.parent.comboTrafType))][1]
-      s.setIcon(QtGui.QIcon(join(ipath, i)))
-
-      if not irow % 2 == 0:
-        d.setBackgroundColor(self.backcolor)
-        h.setBackgroundColor(self.backcolor)
-        s.setBackgroundColor(self.backcolor)
-      
-      self.setItem(irow, 0, d)
-      self.setItem(irow, 1, h)
-      self.setItem(irow, 2, s)
-      irow += 1
-
-    s = QTableWidgetItem("Итого:")
-    s.setTextAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
-    self.setItem(0, 1, s)
-
-    s = QTableWidgetItem(self.parent.comboTrafSize.calc(fullsum))
-    s.setForeground(QtGui.QBrush(QtGui.QColor(244, 0, 0)))
-    self.setItem(0, 2, s)
+    # continue after the last fetched row
+    with self.parent.storage.read() as conn:
+      rows = self.selectPage(conn, self.params, self.group, (self.days[-1],
+          self.lastDays[-1], self.hours[-1]) if self.days else None)
+
+    if rows:
+      first = len(self.days) + 1
+      self.beginInsertRows(QtCore.QModelIndex(), first, first + len(rows) - 1)
+      self.appendRows(rows)
+      self.endInsertRows()
+    else:
+      self.more = False
+
+  def rowCount(self, parent=QtCore.QModelIndex()):
+    return 0 if parent.isValid() else len(self.days) + 1
+
+  def columnCount(self, parent=QtCore.QModelIndex()):
+    return 0 if parent.isValid() else len(self.labels)
+
+  def headerData(self, section, orientation, role=Qt.DisplayRole):
+    if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+      return self.labels[section]
+    return super(tvTableModel, self).headerData(section, orientation, role)
+
+  def data(self, index, role=Qt.DisplayRole):
+    row, col = index.row(), index.column()
+
+    if row == 0:
+      if role == Qt.DisplayRole:
+        if col == 1:
+          return "Итого:"
+        if col == 2:
+          return self.parent.comboTrafSize.calc(self.total[self.direction()])
+      elif role == Qt.TextAlignmentRole and col == 1:
+        return Qt.AlignRight | Qt.AlignVCenter
+      elif role == Qt.ForegroundRole and col == 2:
+        return QtGui.QBrush(self.totalcolor)
+      return None
+
+    i = row - 1
+    if role == Qt.DisplayRole:
+      if col == 0:
+        return tvComboGroup.items[self.group][2].format(
+            from_epoch_day(self.days[i]), from_epoch_day(self.lastDays[i]))
+      if col == 1:
+        if tvComboGroup.items[self.group][1] is None:
+          return "{:02}:00".format(self.hours[i])
+        return "{:02}:00-{:02}:59".format(*self.params[3:])
+      return self.parent.comboTrafSize.calc(self.amounts[self.direction()][i])
+    elif role == Qt.DecorationRole and col == 2:
+      return icon(self.parent.comboTrafType.items[int(str(self.parent.comboTrafType))][1])
+    elif role == Qt.BackgroundRole and row % 2:
+      return QtGui.QBrush(self.backcolor)
+    return None
+
+class tvTable(QtGui.QTableView):
+
+  def __init__(self, parent=None):
+    super(tvTable, self).__init__(parent)
+    self.parent = parent
+    self.setModel(tvTableModel(parent))
+
+  def refresh(self, dateSE, timeSE):
+    self.model().query((TRAFFIC_TYPES.index('LLTRAF_INET'),) +
+        tuple(dateSE) + tuple(timeSE), self.parent.comboGroup.currentIndex())
 
 class tvComboTrafType(QtGui.QComboBox):
   items = (('Входящий', 'left.png'),
@@ -118,11 +295,143 @@ class tvComboTrafType(QtGui.QComboBox):
     super(tvComboTrafType, self).__init__(parent)
 
     self.clear()
-    [ self.addItem(QtGui.QIcon(join(ipath, i[1])), i[0]) for i in self.items ]
+    [ self.addItem(icon(i[1]), i[0]) for i in self.items ]
 
   def __str__(self):
     return str(self.currentIndex())
 
+class tvChart(QtGui.QWidget):
+  """
+    Hourly traffic of both directions over the range. SQL sums the hours
+    and keeps min and max of the hours falling into every pixel column, so
+    the painter gets at most a line per column and direction however long
+    the range is.
+  """
+  # indexed by DIRECTIONS
+  colors = (QtGui.QColor(0, 160, 0), QtGui.QColor(0, 0, 200))
+  margin = 4
+
+  ready = QtCore.pyqtSignal(int, object)
+
+  def __init__(self, parent):
+    super(tvChart, self).__init__(parent)
+    self.parent = parent
+    self.params = None
+    self.stale = False
+    self.generation = 0
+    self.job = None
+    self.clearBuckets()
+    self.ready.connect(self.__ready)
+
+    # the series depends on the width, query once resizing is over
+    self.resizeTimer = QtCore.QTimer(self)
+    self.resizeTimer.setSingleShot(True)
+    self.resizeTimer.setInterval(parent.queryDelay)
+    self.resizeTimer.timeout.connect(self.query)
+
+  def clearBuckets(self):
+    self.columns = 1
+    self.buckets = array('l')
+    # min and max of the hours in the bucket, indexed by DIRECTIONS
+    self.lows = (array('Q'), array('Q'))
+    self.highs = (array('Q'), array('Q'))
+
+  def refresh(self, dateSE, timeSE):
+    self.params = (TRAFFIC_TYPES.index('LLTRAF_INET'),) + tuple(dateSE) + \
+        tuple(timeSE)
+    self.stale = True
+    if self.isVisible():
+      self.query()
+
+  def query(self):
+    if self.params is None:
+      return
+    if self.job is not None:
+      self.job.cancel()
+    self.stale = False
+    self.generation += 1
+    self.job = tvQueryJob(self, self.generation, self.params,
+        max(self.width() - 2 * self.margin, 1))
+    QtCore.QThreadPool.globalInstance().start(self.job)
+
+  def select(self, conn, params, columns):
+    """ Return columns and rows (bucket, min in, max in, min out, max out) """
+    ttype, dayS, dayE, hourS, hourE = params
+    hours = (dayE - dayS + 1) * 24
+    q = "SELECT bucket,min(amountIn),max(amountIn),min(amountOut),max(amountOut)"
+    q+= " FROM (SELECT (day * 24 + hour - ?) * ? / ? AS bucket," + tvTableModel.columns
+    q+= " FROM amounts" + tvTableModel.where + " GROUP BY day,hour)"
+    q+= " GROUP BY bucket ORDER BY bucket"
+    return columns, conn.execute(q, (dayS * 24, columns, hours) + params).fetchall()
+
+  def __ready(self, generation, result):
+    if generation != self.generation:
+      return
+    self.job = None
+    self.clearBuckets()
+    if isinstance(result, Exception):
+      self.parent.setWindowTitle("Ошибка чтения базы: {}".format(result))
+      self.update()
+      return
+    self.columns, rows = result
+    for bucket, lowIn, highIn, lowOut, highOut in rows:
+      self.buckets.append(bucket)
+      self.lows[0].append(lowIn)
+      self.highs[0].append(highIn)
+      self.lows[1].append(lowOut)
+      self.highs[1].append(highOut)
+    self.update()
+
+  def resizeEvent(self, event):
+    super(tvChart, self).resizeEvent(event)
+    self.stale = True
+    if self.isVisible():
+      self.resizeTimer.start()
+
+  def showEvent(self, event):
+    super(tvChart, self).showEvent(event)
+    if self.stale:
+      self.query()
+
+  def paintEvent(self, event):
+    painter = QtGui.QPainter(self)
+    painter.fillRect(self.rect(), Qt.white)
+    if not self.buckets:
+      return
+
+    top = max(max(highs) for highs in self.highs) or 1
+    bottom = self.height() - self.margin
+    sx = (self.width() - 2 * self.margin) / self.columns
+    sy = (self.height() - 2 * self.margin) / top
+    xs = [ self.margin + bucket * sx for bucket in self.buckets ]
+
+    for direction, color in enumerate(self.colors):
+      lows, highs = self.lows[direction], self.highs[direction]
+      painter.setPen(color)
+      painter.drawPolyline(QtGui.QPolygonF([ QtCore.QPointF(x, bottom - high * sy)
+        for x, high in zip(xs, highs) ]))
+      painter.drawLines([ QtCore.QLineF(x, bottom - low * sy, x, bottom - high * sy)
+        for x, low, high in zip(xs, lows, highs) if low != high ])
+
+    painter.setPen(Qt.black)
+    painter.drawText(self.margin, self.margin + self.fontMetrics().ascent(),
+        "{} {}".format(self.parent.comboTrafSize.calc(top),
+          self.parent.comboTrafSize.currentText()))
+
+class tvComboGroup(QtGui.QComboBox):
+  # name, SQL expression of the group (None for hours), format of the
+  # first and the last day of the group
+  items = (('По часам', None, "{0:%d.%m.%Y}"),
+          ('По дням', "day", "{0:%d.%m.%Y}"),
+          ('По неделям', "(day + 3) / 7", "{0:%d.%m.%Y} - {1:%d.%m.%Y}"),
+          ('По месяцам', "strftime('%Y%m', day * 86400, 'unixepoch')", "{0:%m.%Y}"))
+
+  def __init__(self, parent=None):
+    super(tvComboGroup, self).__init__(parent)
+
+    self.clear()
+    [ self.addItem(i[0]) for i in self.items ]
+
 class tvComboTrafSize(QtGui.QComboBox):
   items = ('b', 'Kb', 'Mb', 'Gb')
 
@@ -148,7 +457,7 @@ class tvToolSync(QtGui.QToolButton):
 
   def __init__(self, parent=None):
     super(tvToolSync, self).__init__(parent)
-    self.setIcon(QtGui.QIcon(join(ipath, 'sync.png')))
+    self.setIcon(icon('sync.png'))
     self.setToolTip("Синхронизироваться с сервером")
     self.clicked.connect(self.__sync)
 
@@ -157,9 +466,23 @@ class tvToolSync(QtGui.QToolButton):
     self.setVisible(False)
 
 class QTrafView(QtGui.QWidget):
+  # ms after the last change of the range before querying
+  queryDelay = 250
+  # connections of the pool jobs: the table and the chart
+  jobReaders = 2
 
-  def __init__(self, parent=None):
+  def __init__(self, parent=None, storage=None):
     super(QTrafView, self).__init__(parent)
+    self.storage = storage or Storage()
+    # the storage readers are left to the GUI thread (fetchMore, the tray
+    # tooltip), so it never waits for a long query of a job
+    self.jobConns = Queue()
+    for i in range(self.jobReaders):
+      self.jobConns.put(self.storage.connect(readonly=True))
+    self.queryTimer = QtCore.QTimer(self)
+    self.queryTimer.setSingleShot(True)
+    self.queryTimer.setInterval(self.queryDelay)
+    self.queryTimer.timeout.connect(self.__query)
     vboxRoot = QtGui.QVBoxLayout(self)
 
     ## dates
@@ -187,13 +510,19 @@ class QTrafView(QtGui.QWidget):
     hboxTablePanel.addWidget(QtGui.QLabel("Трафик", self))
     self.comboTrafType = tvComboTrafType(self)
     self.comboTrafSize = tvComboTrafSize(self)
+    self.comboGroup = tvComboGroup(self)
     hboxTablePanel.addWidget(self.comboTrafType)
     hboxTablePanel.addWidget(self.comboTrafSize)
+    hboxTablePanel.addWidget(self.comboGroup)
       #
     vboxTable = QtGui.QVBoxLayout()
     self.table = tvTable(self)
+    self.chart = tvChart(self)
+    self.tabs = QtGui.QTabWidget(self)
+    self.tabs.addTab(self.table, "Таблица")
+    self.tabs.addTab(self.chart, "График")
     vboxTable.addLayout(hboxTablePanel)
-    vboxTable.addWidget(self.table)
+    vboxTable.addWidget(self.tabs)
 
     ##
     vboxRoot.addLayout(hboxDRange)
@@ -209,8 +538,19 @@ class QTrafView(QtGui.QWidget):
     self.timeE.timeChanged.connect(self.__timeCheck)
     self.dateS.dateChanged.connect(self.__timeCheck)
     self.dateE.dateChanged.connect(self.__timeCheck)
-    self.comboTrafType.currentIndexChanged.connect(self.__timeCheck)
-    self.comboTrafSize.currentIndexChanged.connect(self.__timeCheck)
+    self.comboTrafType.currentIndexChanged.connect(self.table.model().redraw)
+    self.comboTrafSize.currentIndexChanged.connect(self.table.model().redraw)
+    self.comboTrafSize.currentIndexChanged.connect(lambda i: self.chart.update())
+    self.comboGroup.currentIndexChanged.connect(self.__timeCheck)
+
+  @contextmanager
+  def jobRead(self):
+    """ Borrow a read-only connection of the pool jobs """
+    conn = self.jobConns.get()
+    try:
+      yield conn
+    finally:
+      self.jobConns.put(conn)
 
   __lockQuery = False
   def __timeCheck(self):
@@ -220,7 +560,13 @@ class QTrafView(QtGui.QWidget):
 
     else:
       self.setWindowTitle("Обзор трафика от {} по {}".format(str(self.dateS),str(self.dateE)))
-      self.table.refresh(
-          (str(self.dateS), str(self.dateE)),
-          (str(self.timeS), str(self.timeE)))
+      # coalesce changes while the editors are spinning
+      self.queryTimer.start()
+
+  def __query(self):
+    if not self.__lockQuery:
+      dateSE = (self.dateS.day(), self.dateE.day())
+      timeSE = (int(str(self.timeS)), int(str(self.timeE)))
+      self.table.refresh(dateSE, timeSE)
+      self.chart.refresh(dateSE, timeSE)
 
@@ -9,7 +9,8 @@ from PyQt4 import QtCore
 
 from settings import config, save_config
 
-from utm5client import UTM5Client
+from utm5client import UTM5Client, split_amounts
+from utm5sync import month_totals
 from qwingschat import QWingsChat
 from qtrafview import QTrafView
 
@@ -24,7 +25,7 @@ class QUtm5Gui(QtGui.QApplication):
         self.utm5client = UTM5Client(auto_auth=True)
 
         self.chat = QWingsChat(app=self)
-        self.traf = QTrafView()
+        self.traf = QTrafView(storage=self.utm5client.db)
         if config['chat']['show'] == "True":
             self.chat.show()
 
@@ -67,7 +68,14 @@ class QUtm5Gui(QtGui.QApplication):
 
     def update_tooltip(self):
 
-        daytime, full = self.utm5client.get_month_traffic()
+        synced = month_totals(self.utm5client.workdir, self.utm5client.url,
+                config['utm5']['login'])
+        contract = synced and synced[1].get(self.utm5client.cid or synced[0])
+        if contract and 'LLTRAF_INET' in contract['types']:
+            daytime, full = split_amounts(contract['types']['LLTRAF_INET'],
+                    self.utm5client.hours)
+        else:
+            daytime, full = self.utm5client.get_month_traffic()
 
         def hum(size):
             return '%.2f МиБ' % (float(size)/(2**20),)
@@ -76,6 +84,8 @@ class QUtm5Gui(QtGui.QApplication):
                 'Дневной исходящий: {}\r\n'
                 'Полный входящий: {}\r\n'
                 'Полный исходящий: {}').format(*map(hum, daytime + full))
+        if self.utm5client.http.breaker.is_open:
+            tooltip += '\r\nНет связи с UTM5, данные из кэша'
         self.trayIcon.setToolTip(tooltip)
 
     def toggle_chat(self):
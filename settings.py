@@ -1,36 +1,158 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import os
-from configparser import RawConfigParser
+import os, time, threading, atexit
 
 
 DEFAULT_WORKDIR = os.path.expanduser(os.path.join('~', '.wingsitv'))
 
-config = RawConfigParser()
 configfile = os.path.join(DEFAULT_WORKDIR, 'config.ini')
 
-if not os.path.exists(DEFAULT_WORKDIR):
-    os.makedirs(DEFAULT_WORKDIR)
-
-def save_config():
-    with open(configfile, 'w') as f: config.write(f)
-
-if os.path.exists(configfile):
-      config.read(configfile)
-
-if 'chat' not in config:
-    config['chat'] = {
+DEFAULTS = {
+    'chat': {
             'login': None,
             'show': True
-        }
-
-if 'utm5' not in config:
-    config['utm5'] = {
+        },
+    'utm5': {
             'login': None,
             'passwd': None,
             'show': None,
             'url': 'https://mnx.net.ru/utm5',
-            'hours': '01-10'
-        }
+            'hours': '01-10',
+            'workers': '4',
+            'pool_size': '4',
+            'timeout': '30',
+            'rate': '0',
+            'retries': '3'
+        },
+}
+
+class ConfigStore(object):
+    """
+        config.ini held in memory, so reading settings is a dict lookup.
+
+        The file is re-read only when its mtime changes (checked at most
+        every `check_interval` seconds), keeping changes not saved yet.
+        `save` batches changes and writes them `delay` seconds after the
+        last call, merged into the file as other processes left it, to a
+        temporary file renamed over config.ini, so the file is always
+        whole.
+    """
+
+    check_interval = 1
+    delay = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.parser = None
+        # {section: {key: value}} as in the file
+        self.loaded = {}
+        self.mtime = None
+        self.checked = 0
+        self.timer = None
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def snapshot(self, parser):
+        return {section: dict(parser[section]) for section in parser.sections()}
+
+    def changes(self):
+        """Return {(section, key): value} changed since the file was read."""
+        return {(section, key): value
+                for section, values in self.snapshot(self.parser).items()
+                for key, value in values.items()
+                if key not in self.loaded.get(section, {})
+                or self.loaded[section][key] != value}
+
+    def reload(self):
+        from configparser import RawConfigParser
+        changes = self.changes() if self.parser is not None else {}
 
+        parser = RawConfigParser()
+        self.mtime = self.file_mtime()
+        if self.mtime is not None:
+            parser.read(self.path)
+        for section, values in DEFAULTS.items():
+            if section not in parser:
+                parser[section] = values
+        self.loaded = self.snapshot(parser)
+
+        for (section, key), value in changes.items():
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, key, value)
+        self.parser = parser
+
+    def get(self):
+        """Return RawConfigParser with the current config."""
+        with self.lock:
+            now = time.monotonic()
+            if self.parser is None or now - self.checked >= self.check_interval \
+                    and self.file_mtime() != self.mtime:
+                self.reload()
+                self.checked = now
+            elif now - self.checked >= self.check_interval:
+                self.checked = now
+            return self.parser
+
+    def save(self):
+        """Write changes to the file `delay` seconds after the last call
+        (and at exit)."""
+        with self.lock:
+            if self.timer is None:
+                atexit.register(self.flush)
+            else:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write changes to the file now."""
+        import tempfile
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            if self.parser is None:
+                return
+            if self.file_mtime() != self.mtime:
+                self.reload()
+            if not self.changes() and self.mtime is not None:
+                return
+
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(prefix='.config', dir=directory)
+            try:
+                with open(fd, 'w') as f:
+                    self.parser.write(f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.mtime = self.file_mtime()
+            self.loaded = self.snapshot(self.parser)
+
+    def __getitem__(self, section):
+        return self.get()[section]
+
+    def __setitem__(self, section, values):
+        self.get()[section] = values
+
+    def __contains__(self, section):
+        return section in self.get()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+config = ConfigStore(configfile)
+
+def save_config():
+    config.save()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmarks of UTM5Client sync against the local UTM5 stub.
+
+import os, sys, time, random, shutil, tempfile, tracemalloc, subprocess, logging
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from contextlib import contextmanager
+
+from utm5client import UTM5Client, TrafficParser
+from utm5stub import UTM5Stub, UTM5StubHandler
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+@contextmanager
+def count_queries(storage):
+    """Count SQL statements executed by all connections of `storage`."""
+    counter = Counter()
+    conns = [storage.writer] + list(storage.readers.queue)
+    for conn in conns:
+        conn.set_trace_callback(counter)
+    try:
+        yield counter
+    finally:
+        for conn in conns:
+            conn.set_trace_callback(None)
+
+
+def measure(stub, client, func, *args, **kwargs):
+    """Run `func` and return dict of its time, HTTP requests, received bytes,
+    SQL statements and peak memory."""
+    requests, sent = stub.requests, stub.bytes_sent
+    tracemalloc.start()
+    try:
+        with count_queries(client.db) as queries:
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'time': elapsed,
+        'requests': stub.requests - requests,
+        'bytes': stub.bytes_sent - sent,
+        'queries': queries.count,
+        'peak': peak,
+    }
+
+
+def bench_month(stub, year, month, workdir, **client_kw):
+    """
+        Measure get_contracts_traffic of specified month with empty cache
+        (cold), repeated by the same client (warm) and by a new client with
+        the cache and session of the first one (restart).
+    """
+    client = UTM5Client(stub.url, '01-07', workdir, **client_kw)
+    results = [('cold', measure(stub, client, lambda: (
+        client.start_session('bench', 'bench'),
+        client.get_contracts_traffic(year, month))))]
+    results.append(('warm', measure(stub, client, client.get_contracts_traffic,
+        year, month)))
+
+    client = UTM5Client(stub.url, '01-07', workdir, **client_kw)
+    results.append(('restart', measure(stub, client, lambda: (
+        client.start_session('bench', 'bench'),
+        client.get_contracts_traffic(year, month)))))
+
+    return results
+
+
+def traffic_page(rows):
+    """Return well-formed cp1251 LL_TRAFFIC2 page with specified number of
+    rows."""
+    return ('<HTML><BODY><TABLE>' + ''.join(UTM5StubHandler.traffic_row.format(
+        n=i + 1, date='01.02.11', hour=i // 2 % 24, login='user',
+        direction='<>'[i % 2], traffic='Интернет', amount=i * 1021)
+        for i in range(rows)) + '</TABLE></BODY></HTML>').encode('cp1251')
+
+
+def fuzz_corpus(size, count=50, seed=0):
+    """
+        Yield (name, page) of malformed LL_TRAFFIC2 pages of about `size`
+        bytes: random mutations of a valid page and known worst cases for
+        a backtracking regular expression.
+    """
+    rnd = random.Random(seed)
+    page = traffic_page(size // 200 + 1)[:size]
+    # a row cut right before the traffic type
+    prefix = UTM5StubHandler.traffic_row.split('{traffic}')[0].format(n=1,
+            date='01.02.11', hour=0, login='user', direction='<').encode('cp1251')
+
+    yield 'no rows', b'a' * size
+    yield 'only <TR>', b'<TR>' * (size // 4)
+    yield 'unterminated rows', (prefix + b'a' * 200) * (size // (len(prefix) + 200))
+    yield 'long words', prefix + b'w ' * (size // 2)
+    yield 'nbsp runs', b'<TR>' + b'&nbsp;' * (size // 6)
+    yield 'invalid bytes', bytes(rnd.randrange(256) for i in range(size))
+
+    for i in range(count):
+        mutated = bytearray(page)
+        for j in range(rnd.randrange(1, 20)):
+            pos = rnd.randrange(len(mutated))
+            op = rnd.randrange(4)
+            if op == 0:
+                del mutated[pos:pos + rnd.randrange(1, 100)]
+            elif op == 1:
+                mutated[pos:pos] = mutated[pos:pos + rnd.randrange(1, 500)]
+            elif op == 2:
+                mutated[pos] = rnd.randrange(256)
+            else:
+                mutated[pos:pos] = rnd.choice((b'<TR>', b'&nbsp;', b'<', b'>',
+                    b' ', b'9' * 30, b'\x98'))
+        yield 'mutation %d' % i, bytes(mutated[:rnd.randrange(len(mutated)) + 1])
+
+
+def parse_time(page, chunk_size=16384, repeat=3):
+    """Return best time of parsing `page` fed by chunks of `chunk_size`."""
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        parser = TrafficParser()
+        for row in parser.parse(page[i:i + chunk_size]
+                for i in range(0, len(page), chunk_size)):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parser(sizes, out=sys.stdout):
+    """
+        Report parsing speed of well-formed and fuzzed pages of specified
+        sizes. It should not depend on page size or contents.
+    """
+    out.write('%-20s %10s %10s %12s\n' % ('page', 'KiB', 'time, ms',
+        'MiB/s'))
+    for size in sizes:
+        page = traffic_page(size // 200)
+        cases = [('%d rows' % (size // 200), page)]
+        worst = None
+        for name, fuzzed in fuzz_corpus(size):
+            elapsed = parse_time(fuzzed, repeat=1)
+            if worst is None or elapsed / len(fuzzed) > worst[2] / len(worst[1]):
+                worst = ('worst: ' + name, fuzzed, elapsed)
+        cases.append(worst[:2])
+        for name, data in cases:
+            elapsed = parse_time(data)
+            out.write('%-20s %10.1f %10.2f %12.1f\n' % (name[:20],
+                len(data) / 1024, elapsed * 1000, len(data) / elapsed / 2**20))
+
+
+def bench_startup(stub, workdir, repeat=20):
+    """
+        Return best times of importing utm5client and of running its CLI up
+        to the first request to UTM5, both in a new interpreter.
+    """
+    home = os.path.join(workdir, 'home')
+    os.makedirs(os.path.join(home, '.wingsitv'), exist_ok=True)
+    env = dict(os.environ, HOME=home)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'utm5client.py')
+
+    imports, first_request = [], []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import utm5client'],
+                cwd=os.path.dirname(script), env=env)
+        imports.append(time.time() - start)
+
+        stub.first_request = None
+        start = time.time()
+        subprocess.check_call([sys.executable, script, '-S', '-c', '-l',
+            'bench', '-p', 'bench', '-u', stub.url, '-w', os.path.join(workdir,
+                'startup%d' % i)], env=env, stdout=subprocess.DEVNULL)
+        first_request.append(stub.first_request - start)
+
+    return min(imports), min(first_request)
+
+
+def report(results, out=sys.stdout):
+    out.write('%-10s %10s %9s %10s %9s %10s\n' % ('case', 'time, ms',
+        'requests', 'KiB', 'queries', 'peak, KiB'))
+    for name, r in results:
+        out.write('%-10s %10.1f %9d %10.1f %9d %10.1f\n' % (name,
+            r['time'] * 1000, r['requests'], r['bytes'] / 1024, r['queries'],
+            r['peak'] / 1024))
+
+
+if __name__ == '__main__':
+    last_month = datetime.today().replace(day=1) - timedelta(days=1)
+
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-m', '--month', dest='month', metavar='MM.YYYY',
+            help='месяц (по умолчанию: %default)',
+            default=last_month.strftime('%m.%Y'))
+    parser.add_option('-c', '--contracts', dest='contracts', type='int',
+            default=1, help='число договоров (по умолчанию: %default)')
+    parser.add_option('-H', '--hours', dest='hours', type='int', default=24,
+            help='число часов с трафиком в сутках (по умолчанию: %default)')
+    parser.add_option('-L', '--latency', dest='latency', type='float',
+            default=0.05,
+            help='задержка ответа в секундах (по умолчанию: %default)')
+    parser.add_option('-e', '--error-rate', dest='error_rate', type='float',
+            default=0, help='доля ответов с ошибкой (по умолчанию: %default)')
+    parser.add_option('-j', '--jobs', dest='workers', type='int', default=4,
+            help='число одновременных запросов (по умолчанию: %default)')
+    parser.add_option('-p', '--parser', action='store_true', dest='parser',
+            help='замерить только разбор страниц LL_TRAFFIC2', default=False)
+    parser.add_option('-s', '--startup', action='store_true', dest='startup',
+            help='замерить только время запуска utm5client.py', default=False)
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+            help='вывод отладочных сообщений', default=False)
+    opt, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if opt.debug else logging.WARNING,
+            format="%(funcName)s: %(message)s")
+
+    if opt.parser:
+        bench_parser([ 2**i * 1024 for i in (4, 8, 12) ])
+        sys.exit()
+
+    month, year = [ int(i) for i in opt.month.split('.') ]
+
+    stub = UTM5Stub(contracts=opt.contracts, hours=opt.hours,
+            latency=opt.latency, error_rate=opt.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix='utm5bench')
+    try:
+        if opt.startup:
+            imports, first_request = bench_startup(stub, workdir)
+            sys.stdout.write('import: %.1f ms, first request: %.1f ms\n' % (
+                imports * 1000, first_request * 1000))
+            sys.exit()
+        report(bench_month(stub, year, month, workdir, workers=opt.workers,
+            pool_size=opt.workers))
+    finally:
+        stub.stop()
+        shutil.rmtree(workdir)
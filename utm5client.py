@@ -35,137 +35,995 @@
 
 __all__ = [ 'UTM5Client', 'config', 'save_config' ]
 
-import re, sys, os, getpass
-from optparse import OptionParser
-from urllib.request import urlopen
-from urllib.parse import urlencode
+import re, sys, os
+import zlib, codecs, time, threading, json, random
+from collections import deque
+from queue import Queue, LifoQueue, Empty, Full
 from datetime import datetime, timedelta
-from getpass import getpass
+from functools import lru_cache
+from contextlib import contextmanager
+from array import array
 import logging
-import sqlite3
 
+# http.client, urllib, sqlite3, concurrent.futures, numpy and the like are
+# imported where they are used, so the CLI starts fast and can answer from
+# utm5sync without loading them at all
+
+from settings import config, save_config, DEFAULT_WORKDIR
+
+
+def daytime_hours(night):
+    """Return sorted list of daytime hours for night hours given as "N-M"."""
+    begin, end = [ int(i) for i in night.split('-') ]
+
+    if begin < end:
+        night_hours = list(range(begin, end))
+    else:
+        night_hours = list(range(0, end)) + list(range(begin, 24))
+
+    return sorted(set(range(24)) - set(night_hours))
+
+
+def split_amounts(hour_amounts, hours):
+    """Return (daytime_amounts, full_amounts) from list of 24 (in, out)
+    amounts per hour of day and list of daytime hours."""
+    return ([ sum(hour_amounts[h][d] for h in set(hours)) for d in (0, 1) ],
+            [ sum(hour_amounts[h][d] for h in range(24)) for d in (0, 1) ])
+
+
+def date_range(start, end):
+    """Return list of dates from start to end inclusive."""
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+DIRECTIONS = {'in': 0, 'out': 1}
+
+TRAFFIC_TYPES = ('LLTRAF_INET', 'LLTRAF_MM', 'LLTRAF_LOC')
+
+
+def epoch_day(date):
+    """Return number of days since 1970-01-01 for specified date."""
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def from_epoch_day(day):
+    """Return date for specified number of days since 1970-01-01."""
+    return datetime.fromordinal(day + EPOCH_ORDINAL).date()
+
+
+@lru_cache(maxsize=None)
+def load_numpy():
+    """Return numpy module or None if it is not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+@lru_cache(maxsize=1024)
+def utm5_day(date):
+    """Return epoch day for date in UTM5 "dd.mm.yy" format."""
+    return epoch_day(datetime.strptime(date, '%d.%m.%y'))
+
+
+class Stats(object):
+    """
+        Thread-safe counters and timers of the sync pipeline, shared by
+        UTM5Client and its Storage, HTTPPool and TrafficParsers.
+
+        Recording an event costs a lock and a dict update, so it is always
+        on. Counters named "<x>.hits" and "<x>.misses" also give the hit
+        rate of "<x>".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            # {name: [number of calls, seconds]}
+            self.timers = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Add the time spent in the block to timer `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+            Return {'counters': {name: n}, 'timers': {name: (calls, seconds)},
+            'hit_rates': {name: rate}} of everything recorded so far.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name: tuple(timer) for name, timer in self.timers.items()}
+
+        hit_rates = {}
+        for name in counters:
+            base, kind = name.rsplit('.', 1) if '.' in name else (name, '')
+            if kind in ('hits', 'misses'):
+                hits = counters.get(base + '.hits', 0)
+                hit_rates[base] = hits / (hits + counters.get(base + '.misses', 0))
+
+        return {'counters': counters, 'timers': timers, 'hit_rates': hit_rates}
+
+    def report(self, out=sys.stderr):
+        snapshot = self.snapshot()
+        for name, (calls, seconds) in sorted(snapshot['timers'].items()):
+            out.write('%-20s %8d calls %10.1f ms\n' % (name, calls, seconds * 1000))
+        for name, n in sorted(snapshot['counters'].items()):
+            out.write('%-20s %8d\n' % (name, n))
+        for name, rate in sorted(snapshot['hit_rates'].items()):
+            out.write('%-20s %7.1f%% hits\n' % (name, rate * 100))
 
-from settings import *
 
 class Storage(object):
 
-    def __init__(self, workdir=DEFAULT_WORKDIR):
-        self.dbname = os.path.join(workdir, 'sqlite.db')
-        if not os.path.exists(self.dbname):
-            self.create_db()
-        self.db = sqlite3.connect(self.dbname)
-
-    def create_db(self):
-        with sqlite3.connect(self.dbname) as conn:
-            conn.executescript("""
-create table amounts_in (
-        cid integer,
-        date char(8),
-        hour integer,
-        amount bigint,
-        primary key(cid, date, hour)
-);
+    schema_version = 2
 
-create table amounts_out (
+    schema = """
+create table amounts (
         cid integer,
-        date char(8),
+        ttype integer,
+        day integer,
         hour integer,
+        direction integer,
         amount bigint,
-        primary key(cid, date, hour)
-);
+        primary key(cid, ttype, day, hour, direction)
+) without rowid;
+
+create index amounts_by_day on amounts(day, hour, ttype, direction, amount);
 
 create table fixeddays (
         cid integer,
-        date char(8),
-        primary key(cid, date)
-);
-                        """)
+        ttype integer,
+        day integer,
+        primary key(cid, ttype, day)
+) without rowid
+"""
+
+    def __init__(self, workdir=DEFAULT_WORKDIR, readers=2, timeout=10,
+            stats=None):
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        self.dbname = os.path.join(workdir, 'sqlite.db')
+        self.stats = stats or Stats()
+        self.timeout = timeout
+        self.writer = self.connect()
+        self.write_lock = threading.RLock()
+        self.migrate()
+        self.fixed = {}
+        self.fixed_lock = threading.Lock()
+        self.readers = Queue()
+        for i in range(max(1, readers)):
+            self.readers.put(self.connect(readonly=True))
+
+    def connect(self, readonly=False):
+        """
+            Open a new connection to the database. Connections may be shared
+            between threads, but each one must be used by a single thread at
+            a time (see `read` and `write`).
+        """
+        import sqlite3
+        if readonly:
+            from urllib.request import pathname2url
+            conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.dbname),
+                    timeout=self.timeout, check_same_thread=False, uri=True)
+        else:
+            conn = sqlite3.connect(self.dbname, timeout=self.timeout,
+                    check_same_thread=False)
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+        return conn
+
+    @contextmanager
+    def read(self):
+        """
+            Borrow a read-only connection from the pool. In WAL mode readers
+            see the last committed data and never wait for the writer.
+        """
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Serialize writers and run the block in a single transaction."""
+        with self.write_lock, self.writer:
+            yield self.writer
+
+    def create_db(self, conn):
+        for statement in self.schema.split(';'):
+            conn.execute(statement)
+
+    def migrate(self):
+        """Create database or upgrade it to the current schema in place."""
+        version = self.writer.execute('pragma user_version').fetchone()[0]
+        if version == self.schema_version:
+            return
 
-    def date_is_fixed(self, cid, date):
+        with self.write() as conn:
+            conn.execute('begin immediate')
+            # another process could have migrated it meanwhile
+            version = conn.execute('pragma user_version').fetchone()[0]
+            if version == self.schema_version:
+                return
+            tables = {row[0] for row in conn.execute(
+                "select name from sqlite_master where type = 'table'")}
+            if version == 0 and 'amounts_in' in tables:
+                self.migrate_v0(conn)
+            elif version == 1:
+                self.migrate_v1(conn)
+            else:
+                self.create_db(conn)
+            conn.execute('pragma user_version = %d' % self.schema_version)
+
+    def migrate_v0(self, conn):
+        """Upgrade from separate amounts_in/amounts_out tables keyed by
+        "dd.mm.yy" date strings, all of them internet traffic."""
+        logging.info('Migrating %s from schema version 0' % self.dbname)
+        day = ("cast(julianday('20' || substr(date, 7, 2) || '-' || "
+            "substr(date, 4, 2) || '-' || substr(date, 1, 2)) - "
+            "julianday('1970-01-01') as integer)")
+        conn.execute('alter table fixeddays rename to fixeddays_v0')
+        self.create_db(conn)
+        for direction, table in enumerate(('amounts_in', 'amounts_out')):
+            conn.execute('insert or replace into amounts select cid, 0, '
+                '{0}, hour, {1}, amount from {2}'.format(day, direction, table))
+            conn.execute('drop table ' + table)
+        conn.execute('insert or ignore into fixeddays select cid, 0, '
+                '{0} from fixeddays_v0'.format(day))
+        conn.execute('drop table fixeddays_v0')
+
+    def migrate_v1(self, conn):
+        """Upgrade from tables without traffic type, all of them internet
+        traffic."""
+        logging.info('Migrating %s from schema version 1' % self.dbname)
+        conn.execute('drop index amounts_by_day')
+        conn.execute('alter table amounts rename to amounts_v1')
+        conn.execute('alter table fixeddays rename to fixeddays_v1')
+        self.create_db(conn)
+        conn.execute('insert into amounts select cid, 0, day, hour, '
+                'direction, amount from amounts_v1')
+        conn.execute('insert into fixeddays select cid, 0, day from fixeddays_v1')
+        conn.execute('drop table amounts_v1')
+        conn.execute('drop table fixeddays_v1')
+
+    def fixed_days(self, cid, traffic_type="LLTRAF_INET"):
+        """
+            Return bitmap of fixed days for specified contract and traffic
+            type, bit N is set if epoch day N is fixed. Loaded once and kept
+            up to date by `update_days`.
+        """
+        key = int(cid), TRAFFIC_TYPES.index(traffic_type)
+        with self.fixed_lock:
+            if key not in self.fixed:
+                with self.read() as conn, self.stats.timer('db.load_fixed'):
+                    days = [row[0] for row in conn.execute('select day from '
+                        'fixeddays where cid = ? and ttype = ?', key)]
+                bitmap = bytearray(max(days, default=0) // 8 + 1)
+                for day in days:
+                    bitmap[day >> 3] |= 1 << (day & 7)
+                self.fixed[key] = int.from_bytes(bitmap, 'little')
+            return self.fixed[key]
+
+    def date_is_fixed(self, cid, date, traffic_type="LLTRAF_INET"):
         """Check if all data for specified date is cached and fixed."""
-        date = date.strftime('%d.%m.%y')
-        with self.db:
-            c = self.db.cursor()
-            c.execute("select count(*) from fixeddays where cid = ? and date = ?", (cid, date))
-            return c.fetchone()[0] == 1
+        return bool(self.fixed_days(cid, traffic_type) >> epoch_day(date) & 1)
 
-    def update_data(self, cid, data):
+    def missing_dates(self, cid, start, end, traffic_types=("LLTRAF_INET",)):
+        """Return list of dates from start to end inclusive, which are not
+        fixed for any of specified traffic types."""
+        first, count = epoch_day(start), (end - start).days + 1
+        if count <= 0:
+            return []
+        fixed = ~0
+        for traffic_type in traffic_types:
+            fixed &= self.fixed_days(cid, traffic_type)
+        missing = ~(fixed >> first) & ((1 << count) - 1)
+        dates = []
+        while missing:
+            low = missing & -missing
+            dates.append(from_epoch_day(first + low.bit_length() - 1))
+            missing ^= low
+        # hit rate of the cache by days
+        self.stats.count('days.hits', count - len(dates))
+        self.stats.count('days.misses', len(dates))
+        return dates
+
+    def fixed_dates(self, cid, start, end, traffic_type="LLTRAF_INET"):
+        """Return set of fixed dates from start to end inclusive."""
+        return set(date_range(start, end)) - set(self.missing_dates(cid,
+            start, end, (traffic_type,)))
+
+    def update_data(self, cid, data, traffic_type="LLTRAF_INET"):
         """Update database with specified data."""
-        with self.db:
-                self.db.executemany('insert or replace into amounts_in values (?, ?, ?, ?)', [
-                        (cid, d[1], d[2], d[3]) for d in data if d[0] == 'in'
+        self.update_days(cid, {traffic_type: data}, [])
+
+    def update_days(self, cid, data, dates):
+        """
+            Update database with specified data, given as {traffic_type:
+            rows}, and fix specified dates for each of these traffic types,
+            all in a single transaction.
+        """
+        self.update_contracts({cid: (data, dates)})
+
+    def update_contracts(self, updates):
+        """Same as `update_days` for several contracts, given as {cid:
+        (data, dates)}, in a single transaction."""
+        with self.write() as conn, self.stats.timer('db.write'):
+            for cid, (data, dates) in updates.items():
+                self.stats.count('db.rows', sum(map(len, data.values())))
+                conn.executemany('insert or replace into amounts values (?, ?, ?, ?, ?, ?)', [
+                        (cid, TRAFFIC_TYPES.index(traffic_type), utm5_day(d[1]),
+                            d[2], DIRECTIONS[d[0]], d[3])
+                        for traffic_type, rows in data.items() for d in rows
                     ])
-                self.db.executemany('insert or replace into amounts_out values (?, ?, ?, ?)', [
-                        (cid, d[1], d[2], d[3]) for d in data if d[0] == 'out'
+                conn.executemany('insert or ignore into fixeddays values (?, ?, ?)', [
+                        (cid, TRAFFIC_TYPES.index(traffic_type), epoch_day(date))
+                        for traffic_type in data for date in dates
                     ])
 
-    def fix_date(self, cid, date):
+        with self.fixed_lock:
+            for cid, (data, dates) in updates.items():
+                if not dates:
+                    continue
+                bits = sum(1 << day for day in {epoch_day(date) for date in dates})
+                for traffic_type in data:
+                    key = int(cid), TRAFFIC_TYPES.index(traffic_type)
+                    if key in self.fixed:
+                        self.fixed[key] |= bits
+
+    def fix_date(self, cid, date, traffic_type="LLTRAF_INET"):
         """Mark cached data for specified date as fixed."""
-        date = date.strftime('%d.%m.%y')
-        with self.db:
-            self.db.execute('insert or ignore into fixeddays values (?, ?)', (cid, date))
+        self.update_days(cid, {traffic_type: []}, [date])
 
-    def get_amounts(self, cid, date, hours):
+    def get_amounts(self, cid, date, hours, traffic_type="LLTRAF_INET"):
         """Return cached traffic amounts for specified date split and specified hours."""
-        date = date.strftime('%d.%m.%y')
-        with self.db:
-            c = self.db.cursor()
-            c.execute('select sum(amount) from amounts_in where cid = ? and date = ? and hour in (' + ','.join(['?'] * len(hours)) +')', (cid, date) + tuple(hours))
-            sum_in = c.fetchone()[0] or 0
-            c.close()
-            c = self.db.cursor()
-            c.execute('select sum(amount) from amounts_out where cid = ? and date = ? and hour in (' + ','.join(['?'] * len(hours)) + ')', (cid, date) + tuple(hours))
-            sum_out = c.fetchone()[0] or 0
-            c.close()
+        return self.get_range_amounts(cid, date, date, hours, traffic_type)[0]
+
+    def get_range_amounts(self, cid, start, end, hours, traffic_type="LLTRAF_INET"):
+        """
+            Return cached traffic amounts from start to end dates inclusive
+            as ((in, out) for specified hours, (in, out) for whole days).
+        """
+        hours = tuple(hours)
+        amounts = {direction: (0, 0) for direction in DIRECTIONS.values()}
+        with self.read() as conn:
+            c = conn.execute('select direction, '
+                    'sum(case when hour in (' + ','.join(['?'] * len(hours)) + ') '
+                    'then amount else 0 end), sum(amount) from amounts '
+                    'where cid = ? and ttype = ? and day between ? and ? '
+                    'group by direction', hours + (cid,
+                        TRAFFIC_TYPES.index(traffic_type), epoch_day(start),
+                        epoch_day(end)))
+            for direction, hours_sum, full_sum in c:
+                amounts[direction] = (hours_sum, full_sum)
+
+        return (amounts[0][0], amounts[1][0]), (amounts[0][1], amounts[1][1])
+
+    periods = ('hour', 'day', 'month')
+
+    def export(self, start, end, cids=None, traffic_types=TRAFFIC_TYPES,
+            period='hour'):
+        """
+            Yield (cid, traffic_type, day, hour, in, out) of cached traffic
+            from start to end dates inclusive, ordered by contract, traffic
+            type and time. `day` is the epoch day of the period start, `hour`
+            is None unless `period` is 'hour' ('day' and 'month' sum hours).
+
+            Rows are read from the cursor as they are consumed, in primary
+            key order, so neither SQLite nor Python holds more than a row
+            whatever the range is.
+        """
+        if period == 'month':
+            yield from self.rollup_months(self.export(start, end, cids,
+                traffic_types, 'day'))
+            return
+
+        ttypes = [TRAFFIC_TYPES.index(traffic_type) for traffic_type in traffic_types]
+        with self.read() as conn:
+            if not cids:
+                # only today's data is not fixed
+                cids = [row[0] for row in conn.execute('select cid from '
+                    'fixeddays union select cid from amounts where day = ?',
+                    (epoch_day(datetime.today()),))]
+
+            keys = 'cid, ttype, day' + (', hour' if period == 'hour' else '')
+            c = conn.execute('select %s%s, '
+                    'sum(case direction when 0 then amount else 0 end), '
+                    'sum(case direction when 1 then amount else 0 end) '
+                    'from amounts where cid in (%s) and ttype in (%s) and '
+                    'day between ? and ? group by %s order by %s' % (keys,
+                        '' if period == 'hour' else ', null',
+                        ','.join('?' * len(cids)), ','.join('?' * len(ttypes)),
+                        keys, keys),
+                    [int(cid) for cid in cids] + ttypes +
+                    [epoch_day(start), epoch_day(end)])
+            for cid, ttype, day, hour, amount_in, amount_out in c:
+                yield cid, TRAFFIC_TYPES[ttype], day, hour, amount_in, amount_out
+
+    def rollup_months(self, rows):
+        """Sum ordered daily rows of `export` by months."""
+        last = None
+        for cid, traffic_type, day, hour, amount_in, amount_out in rows:
+            first = day - from_epoch_day(day).day + 1
+            if last and tuple(last[:3]) == (cid, traffic_type, first):
+                last[4] += amount_in
+                last[5] += amount_out
+                continue
+            if last:
+                yield tuple(last)
+            last = [cid, traffic_type, first, None, amount_in, amount_out]
+        if last:
+            yield tuple(last)
+
+
+def export_csv(rows, f):
+    """Write rows of `Storage.export` to text file `f` as CSV."""
+    import csv
+    writer = csv.writer(f)
+    writer.writerow(('cid', 'type', 'date', 'hour', 'in', 'out'))
+    for cid, traffic_type, day, hour, amount_in, amount_out in rows:
+        writer.writerow((cid, traffic_type, from_epoch_day(day).isoformat(),
+            '' if hour is None else hour, amount_in, amount_out))
+
+
+def export_ndjson(rows, f):
+    """Write rows of `Storage.export` to text file `f` as JSON objects, one
+    per line."""
+    for cid, traffic_type, day, hour, amount_in, amount_out in rows:
+        f.write(json.dumps({'cid': cid, 'type': traffic_type,
+            'date': from_epoch_day(day).isoformat(), 'hour': hour,
+            'in': amount_in, 'out': amount_out}) + '\n')
+
+
+EXPORT_MAGIC = b'UTM5COL1'
+
+def export_columns(rows, f, block=65536):
+    """
+        Write rows of `Storage.export` to binary file `f` in columnar format.
+
+        After EXPORT_MAGIC come blocks of up to `block` rows: row count
+        (uint32), then columns of that many cid (int64), traffic type
+        index in TRAFFIC_TYPES (uint8), epoch day (int32), hour (int8, -1
+        for whole days), in and out (uint64). All numbers are little-endian.
+    """
+    rows = iter(rows)
+    f.write(EXPORT_MAGIC)
+    while True:
+        columns = [array('q'), array('B'), array('i'), array('b'),
+                array('Q'), array('Q')]
+        for cid, traffic_type, day, hour, amount_in, amount_out in rows:
+            columns[0].append(cid)
+            columns[1].append(TRAFFIC_TYPES.index(traffic_type))
+            columns[2].append(day)
+            columns[3].append(-1 if hour is None else hour)
+            columns[4].append(amount_in)
+            columns[5].append(amount_out)
+            if len(columns[0]) == block:
+                break
+        if not columns[0]:
+            break
+        f.write(len(columns[0]).to_bytes(4, 'little'))
+        for column in columns:
+            if sys.byteorder != 'little':
+                column.byteswap()
+            f.write(column.tobytes())
+
+
+EXPORT_FORMATS = {
+    'csv': export_csv,
+    'ndjson': export_ndjson,
+    'columns': export_columns,
+}
+
+
+class TrafficCube(object):
+    """
+        Hourly traffic of a contract from start to end dates inclusive, held
+        in memory as a days x 24 hours x (in, out) block of amounts.
+
+        Sums over any hour mask and date range are computed by strided
+        slices of the block (by numpy if it is available), so comparing
+        different night windows over years of data takes no SQL at all.
+    """
+
+    def __init__(self, storage, cid, start, end, traffic_type="LLTRAF_INET"):
+        self.start, self.end = start, end
+        self.first = epoch_day(start)
+        # empty if end is before start
+        self.days = max((end - start).days + 1, 0)
+        self.data = array('Q', bytes(self.days * 48 * 8))
+
+        with storage.read() as conn:
+            c = conn.execute('select day, hour, direction, amount from amounts '
+                    'where cid = ? and ttype = ? and day between ? and ?',
+                    (cid, TRAFFIC_TYPES.index(traffic_type), self.first,
+                        self.first + self.days - 1))
+            for day, hour, direction, amount in c:
+                self.data[((day - self.first) * 24 + hour) * 2 + direction] = amount
+
+        self.numpy = load_numpy()
+        if self.numpy is not None:
+            self.block = self.numpy.frombuffer(self.data,
+                    dtype=self.numpy.uint64).reshape(self.days, 24, 2)
+
+    def day_slice(self, start=None, end=None):
+        first = 0 if start is None else max(epoch_day(start) - self.first, 0)
+        last = self.days if end is None else \
+                min(epoch_day(end) - self.first + 1, self.days)
+        return first, max(first, last)
+
+    def hour_amounts(self, start=None, end=None):
+        """Return list of 24 (in, out) amounts per hour of day summed from
+        start to end dates inclusive."""
+        first, last = self.day_slice(start, end)
+        if self.numpy is not None:
+            return [ (int(i), int(o)) for i, o in
+                    self.block[first:last].sum(axis=0, dtype=self.numpy.uint64) ]
+        data = self.data[first * 48:last * 48]
+        return [ (sum(data[h * 2::48]), sum(data[h * 2 + 1::48]))
+                for h in range(24) ]
+
+    def sum(self, hours=range(24), start=None, end=None):
+        """Return (in, out) amounts of specified hours from start to end
+        dates inclusive (whole cube by default)."""
+        amounts = self.hour_amounts(start, end)
+        hours = set(hours)
+        return (sum(amounts[h][0] for h in hours),
+                sum(amounts[h][1] for h in hours))
+
+    def split(self, night, start=None, end=None):
+        """Return (daytime_amounts, full_amounts) for night hours given as
+        "N-M", like get_month_traffic does."""
+        return split_amounts(self.hour_amounts(start, end), daytime_hours(night))
+
+
+class HTTPError(Exception):
+    """UTM5 has answered with HTTP status other than 200."""
+
+    def __init__(self, status, reason):
+        super(HTTPError, self).__init__('HTTP error %d: %s' % (status, reason))
+        self.status = status
+
+
+class UTM5Unavailable(Exception):
+    """Request is refused without trying while the circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """
+        Stops requests to a failing server. After `threshold` failures in a
+        row the breaker opens and `check` raises UTM5Unavailable at once
+        for `reset_timeout` seconds. Then a single request is let through:
+        its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
 
-        return sum_in, sum_out
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            wait = self.opened + self.reset_timeout - time.monotonic()
+            if self.trial or wait > 0:
+                raise UTM5Unavailable('UTM5 is unavailable, next try in %d s'
+                        % max(wait, 0))
+            self.trial = True
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                logging.info('UTM5 is available again')
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened is None:
+                    logging.warning('UTM5 failed %d times in a row, pausing '
+                            'requests for %d s' % (self.failures,
+                                self.reset_timeout))
+                self.opened = time.monotonic()
+                self.trial = False
+
+
+class HTTPPool(object):
+    """
+        Pool of persistent (keep-alive) HTTP connections to a single host.
+
+        At most `size` requests are in flight at once and at most `rate`
+        requests are started per second (unlimited if 0), idle connections
+        are kept open and reused by subsequent requests. Every socket
+        operation times out in `timeout` seconds, failures are counted by
+        `breaker`.
+    """
+
+    def __init__(self, url, size=4, timeout=30, rate=0, stats=None,
+            breaker=None):
+        from http.client import HTTPConnection, HTTPSConnection
+        from urllib.parse import urlsplit
+        url = urlsplit(url)
+        self.connection_class = HTTPSConnection if url.scheme == 'https' \
+                else HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.rate = rate
+        self.rate_lock = threading.Lock()
+        self.next_request = 0
+        self.idle = LifoQueue(size)
+        self.latencies = deque(maxlen=100)
+        self.stats = stats or Stats()
+        self.breaker = breaker or CircuitBreaker()
+
+    @property
+    def latency(self):
+        """Duration of the last request in seconds."""
+        return self.latencies[-1] if self.latencies else None
+
+    def get_connection(self):
+        try:
+            return self.idle.get_nowait(), True
+        except Empty:
+            return self.connection_class(self.host, self.port,
+                    timeout=self.timeout), False
+
+    def release_connection(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def throttle(self):
+        """Wait until the next request is allowed by `rate`."""
+        if not self.rate:
+            return
+        with self.rate_lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + 1 / self.rate
+        time.sleep(start - now)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+    def post(self, path, fields, encoding='cp1251'):
+        """Send urlencoded `fields` by POST and return the response body."""
+        return b''.join(self.post_chunks(path, fields, encoding))
+
+    def post_chunks(self, path, fields, encoding='cp1251', chunk_size=16384):
+        """
+            Send urlencoded `fields` by POST and yield chunks of the
+            (decompressed) response body as they arrive.
+        """
+        from http.client import HTTPException, RemoteDisconnected
+        from urllib.parse import urlencode
+        body = bytes(urlencode(fields), encoding)
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        self.breaker.check()
+        with self.stats.timer('http.throttle'):
+            self.throttle()
+        with self.stats.timer('http.wait'):
+            self.slots.acquire()
+        try:
+            while True:
+                conn, reused = self.get_connection()
+                start = time.perf_counter()
+                try:
+                    conn.request('POST', self.path + path, body, headers)
+                    res = conn.getresponse()
+                except (HTTPException, OSError) as e:
+                    conn.close()
+                    self.stats.count('http.errors')
+                    if reused and isinstance(e, (RemoteDisconnected,
+                            BrokenPipeError, ConnectionResetError)):
+                        # server has dropped the idle connection before
+                        # answering, try another one; never on a timeout, as
+                        # the request may have been handled
+                        self.stats.count('http.retries')
+                        continue
+                    self.breaker.failure()
+                    raise
+                break
+
+            if res.status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+            self.stats.count('http.requests')
+            self.stats.count('http.reused' if reused else 'http.connects')
+            self.stats.add_time('http.response', time.perf_counter() - start)
+
+            if res.getheader('Content-Encoding') == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                decompressor = None
+
+            size = 0
+            try:
+                if res.status != 200:
+                    res.read()
+                    raise HTTPError(res.status, res.reason)
+
+                while True:
+                    read_start = time.perf_counter()
+                    chunk = res.read1(chunk_size)
+                    self.stats.add_time('http.read', time.perf_counter() - read_start)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if decompressor:
+                        with self.stats.timer('http.gunzip'):
+                            chunk = decompressor.decompress(chunk)
+                    if chunk:
+                        yield chunk
+
+                if decompressor:
+                    chunk = decompressor.flush()
+                    if chunk:
+                        yield chunk
+            except BaseException as e:
+                # includes GeneratorExit, when the rest of the response is
+                # left unread, so the connection can't be reused anyway
+                conn.close()
+                if isinstance(e, (HTTPException, OSError)):
+                    self.breaker.failure()
+                raise
+            else:
+                res.close()
+                if res.will_close:
+                    conn.close()
+                else:
+                    self.release_connection(conn)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+                self.stats.count('http.bytes', size)
+                logging.debug('POST %s: %d, %d bytes in %.3fs' % (path,
+                    res.status, size, self.latencies[-1]))
+        finally:
+            self.slots.release()
+
+
+class SessionExpired(Exception):
+    """UTM5 does not accept the session ID anymore."""
+
+
+class TrafficParser(object):
+    """
+        Incremental parser of LL_TRAFFIC2 pages.
+
+        The page is split into table rows on "<TR>" as it arrives and every
+        complete row is matched by an anchored regular expression with
+        bounded repetitions, so parsing time is linear in the page size
+        whatever the page contains. Rows longer than `max_row` characters
+        are skipped without being buffered.
+    """
+
+    row_re = re.compile(r'<TD BGCOLOR=#B0B0B0>\d{1,10}<TD ALIGN=LEFT>&nbsp;'
+            r'(?P<date>\d\d\.\d\d\.\d\d)(?: (?P<hour>\d\d):\d\d:\d\d)?&nbsp;'
+            r'<TD ALIGN=LEFT>&nbsp;(?P<login>\w{1,64})&nbsp;<TD ALIGN=CENTER>&nbsp;'
+            r'(?P<direction>[<>])&nbsp;<TD ALIGN=LEFT>&nbsp;(?P<traffic_type>[\w ]{1,64})'
+            r'&nbsp;<TD ALIGN=CENTER>&nbsp;(?P<amount>\d{1,20})&nbsp;')
+    login_form_re = re.compile(r'NAME="?PASSWORD"?', re.IGNORECASE)
+    max_row = 4096
+
+    def __init__(self, encoding='cp1251', stats=None):
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.stats = stats or Stats()
+        self.tail = ''
+        self.skip = False
+        self.login_form = False
+
+    def feed(self, chunk, final=False):
+        """Return list of (direction, date, hour, amount) tuples of the rows
+        completed by `chunk`."""
+        start = time.perf_counter()
+        rows = self.tail + self.decoder.decode(chunk, final)
+        decoded = time.perf_counter()
+        self.stats.add_time('parse.decode', decoded - start)
+
+        rows = rows.split('<TR>')
+        self.tail = '' if final else rows.pop()
+
+        data = []
+        for row in rows:
+            e = None if self.skip else self.row_re.match(row)
+            self.skip = False
+            if e is not None:
+                data.append(("in" if e.group('direction') == "<" else "out",
+                    e.group('date'), int(e.group('hour') or 0),
+                    int(e.group('amount'))))
+            elif not self.login_form:
+                self.login_form = self.login_form_re.search(row) is not None
+
+        if len(self.tail) > self.max_row:
+            # can't be a traffic row, skip it up to the next "<TR>" but keep
+            # enough to find a "<TR>" or the login form split by chunks
+            if not self.login_form:
+                self.login_form = self.login_form_re.search(self.tail) is not None
+            self.tail = self.tail[-16:]
+            self.skip = True
+
+        self.stats.add_time('parse.match', time.perf_counter() - decoded)
+        self.stats.count('parse.rows', len(data))
+        return data
+
+    def parse(self, chunks):
+        """Yield (direction, date, hour, amount) tuples from chunks of a page."""
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.feed(b'', True)
 
 
 class UTM5Client(object):
 
-    traffic_re = re.compile(r'<TR><TD BGCOLOR=#B0B0B0>\d+<TD ALIGN=LEFT>&nbsp;(?P<date>\d\d\.\d\d\.\d\d)( (?P<time>\d\d:\d\d:\d\d)|)&nbsp;<TD ALIGN=LEFT>&nbsp;(?P<login>\w+)&nbsp;<TD ALIGN=CENTER>&nbsp;(?P<direction>[<>])&nbsp;<TD ALIGN=LEFT>&nbsp;(?P<traffic_type>[\w ]+)'
-            '&nbsp;<TD ALIGN=CENTER>&nbsp;(?P<amount>\d+)&nbsp;')
+    # delay before the first retry and the longest one, in seconds
+    backoff = 1
+    max_backoff = 30
+
     contracts_re = re.compile(r'''<A HREF="\?FORMNAME=IP_CONTRACT_INFO&SID=(?P<sid>\w+)&CONTR_ID=(?P<id>\d+)&NLS=WR" TITLE="Посмотреть данные по договору" target="_self" method="post">(?P<name>\w+)</A>
 &nbsp;<TD ALIGN=CENTER>&nbsp;(?P<client>[\w ]+)&nbsp;<TD ALIGN=RIGHT>&nbsp;\d+.\d\d&nbsp;<TD ALIGN=RIGHT>&nbsp;\d+.\d\d&nbsp;''', re.MULTILINE)
 
-    def __init__(self, url=config['utm5']['url'], hours=config['utm5']['hours'],
-            workdir=DEFAULT_WORKDIR, auto_auth=False):
+    def __init__(self, url=None, hours=None, workdir=DEFAULT_WORKDIR,
+            auto_auth=False, workers=None, pool_size=None, timeout=None,
+            rate=None, stats=None, retries=None):
+        """Arguments left None are taken from the utm5 section of config."""
+        utm5 = config['utm5']
+        url = utm5['url'] if url is None else url
+        hours = utm5['hours'] if hours is None else hours
+        workers = int(utm5.get('workers', 4)) if workers is None else workers
+        pool_size = int(utm5.get('pool_size', 4)) if pool_size is None else pool_size
+        timeout = float(utm5.get('timeout', 30)) if timeout is None else timeout
+        rate = float(utm5.get('rate', 0)) if rate is None else rate
+        retries = int(utm5.get('retries', 3)) if retries is None else retries
 
         self.url = url.strip('/')
-        self.hours = hours
-        self.db = Storage(workdir)
+        self.hours = daytime_hours(hours) if isinstance(hours, str) else hours
+        self.workers = max(1, workers)
+        self.retries = max(0, retries)
+        self.workdir = workdir
+        self.stats = stats or Stats()
+        self.http = HTTPPool(self.url, max(1, pool_size), timeout, rate,
+                self.stats)
+        self.db = Storage(workdir, stats=self.stats)
+        self.session_file = os.path.join(workdir, 'session.json')
+        self.auth_lock = threading.Lock()
+        self.cid = None
+        # {(cid, traffic_type): (date, {(direction, hour): amount})}
+        self.today_seen = {}
 
         if auto_auth:
-            self.auth(config['utm5']['login'], config['utm5']['passwd'])
+            self.start_session(config['utm5']['login'], config['utm5']['passwd'])
+
+    def start_session(self, login, passwd):
+        """
+            Resume saved session of specified user or authenticate anew.
+        """
+        self.credentials = login, passwd
+        if self.load_session(login):
+            self.stats.count('session.hits')
+        else:
+            self.stats.count('session.misses')
+            self.auth(login, passwd)
+
+    def load_session(self, login):
+        """
+            Restore contracts and session ID saved by the last `auth` of
+            specified user. Return False if there is no such session.
+        """
+        try:
+            with open(self.session_file) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if session.get('url') != self.url or session.get('login') != login \
+                or not session.get('contracts'):
+            return False
+
+        self.contracts = session['contracts']
+        self.set_contract(session['cid'] if session['cid'] in self.contracts
+                else list(self.contracts)[0])
+        logging.info('Resumed session of "%s", using contract %s' % (login,
+            self.cid))
+        return True
+
+    def save_session(self, login):
+        tmp = self.session_file + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump({'url': self.url, 'login': login, 'cid': self.cid,
+                'contracts': self.contracts}, f)
+        os.replace(tmp, self.session_file)
+
+    def renew_session(self, sid):
+        """
+            Authenticate again, unless another thread has already replaced
+            expired session ID `sid`.
+        """
+        with self.auth_lock:
+            if any(c['sid'] == sid for c in self.contracts.values()):
+                logging.info('Session expired, authenticating again')
+                self.stats.count('session.expired')
+                self.auth(*self.credentials)
 
     def auth(self, login, passwd):
         """
             Authenticates and retrieves a list of available contracts.
         """
+        self.credentials = login, passwd
         logging.info('Authenticating as "{0}"'.format(login))
-        res = urlopen(self.url+'/!w3_p_main.showform',
-            data=bytes(urlencode({'SID': '',
+        res = self.http.post('/!w3_p_main.showform', {'SID': '',
                                         'NLS': 'WR',
                                         'USERNAME': login,
                                         'PASSWORD': passwd,
                                         'FORMNAME': 'IP_CONTRACTS',
                                         'BUTTON': 'Вход'.encode('cp1251')
-                                        }), 'cp1251')).read().decode('cp1251')
+                                        }).decode('cp1251')
 
-        self.contracts = {c.group('id'): c.groupdict() for c in self.contracts_re.finditer(res)}
+        contracts = {c.group('id'): c.groupdict() for c in self.contracts_re.finditer(res)}
 
-        if not self.contracts:
+        if not contracts:
             logging.error('Authentication failed! No contracts!')
             raise Exception('Authentication failed! No contracts!')
 
-        self.set_contract(list(self.contracts)[0])
+        self.contracts = contracts
+        self.set_contract(self.cid if self.cid in contracts else list(contracts)[0])
         logging.info('Authenticated, using contract %s' % self.cid)
+        self.save_session(login)
 
     def set_contract(self, cid):
         self.sid = self.contracts[str(cid)]['sid']
         self.cid = cid
 
-    def request_day_from_utm5(self, date, traffic_type="LLTRAF_INET"):
+    def request_day_from_utm5(self, date, traffic_type="LLTRAF_INET", cid=None):
         """
             Get info from UTM5 client area by HTTP.
 
@@ -175,41 +1033,155 @@ class UTM5Client(object):
                         LLTRAF_INET - internet (default)
                         LLTRAF_MM - multimedia
                         LLTRAF_LOC - local
+            @param cid: contract id, current contract by default
         """
 
-        logging.info('Requesting %d.%d.%d from UTM5' % date.timetuple()[:3])
+        if cid is None:
+            cid = self.cid
 
+        logging.info('Requesting %d.%d.%d for contract %s from UTM5' % (
+            date.timetuple()[:3] + (cid,)))
+
+        from http.client import HTTPException
         month = '%.2d.%d' % (date.month, date.year)
-        day = date.day
 
-        res = urlopen(self.url+'/!w3_p_main.showform',
-            data=bytes(urlencode({
-                                'CONTRACTID': self.cid,
+        # fetching a day is idempotent, so transient failures are retried
+        # after a random delay, up to twice as long each time
+        for attempt in range(self.retries + 1):
+            try:
+                return self.fetch_day(cid, traffic_type, month, date.day)
+            except (HTTPException, OSError, HTTPError) as e:
+                if attempt == self.retries or \
+                        isinstance(e, HTTPError) and e.status < 500:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff,
+                    self.backoff * 2 ** attempt))
+                self.stats.count('http.backoffs')
+                logging.warning('%s, retrying in %.1f s' % (e, delay))
+                time.sleep(delay)
+
+    def fetch_day(self, cid, traffic_type, month, day):
+        """Request a day once, authenticating again if the session has
+        expired."""
+        for retry in (False, True):
+            sid = self.contracts[str(cid)]['sid']
+            parser = TrafficParser(stats=self.stats)
+            res = self.http.post_chunks('/!w3_p_main.showform', {
+                                'CONTRACTID': cid,
                                 "DIR": "",
                                 "SRV": traffic_type,
                                 "MONTH": month,
                                 "DAY": day,
                                 "UNITS_VIEW": "1",
-                                "SID": self.sid,
+                                "SID": sid,
                                 "NLS": "WR",
                                 "FORMNAME": "LL_TRAFFIC2",
                                 "BUTTON": 'Показать'.encode('cp1251')
-                             }), 'cp1251')).read().decode('cp1251')
+                             })
 
-        data = []
+            data = list(parser.parse(res))
 
-        for e in self.traffic_re.finditer(res):
-            direction = "in" if e.group('direction') == "<" else "out"
-            date = e.group('date')
-            time = int((e.group('time') or '00:00:00')[:2])
-            amount = e.group('amount')
-            data.append((direction, date, time, amount))
+            # an expired session gets the login form instead of the traffic
+            if data or not parser.login_form:
+                return data
 
-        return data
+            if retry:
+                raise SessionExpired('UTM5 does not accept new session ID')
 
-    def get_month_traffic(self, year=datetime.today().year,
-        month=datetime.today().month, traffic_type="LLTRAF_INET"):
+            self.renew_session(sid)
+
+    def sync_days(self, missing, traffic_types=("LLTRAF_INET",)):
+        """
+            Get info of specified traffic types for several days of several
+            contracts, given as {cid: [date, ...]}, from UTM5 and save it.
+            At most `self.workers` requests are made at once, all contracts
+            share the current session. All traffic types of a day are fixed
+            together.
+        """
+        jobs = [(cid, date, traffic_type) for cid, dates in missing.items()
+                for date in dates for traffic_type in traffic_types]
+        if not jobs:
+            return
 
+        from concurrent.futures import ThreadPoolExecutor
+        today = datetime.today().date()
+        data = {cid: {traffic_type: [] for traffic_type in traffic_types}
+                for cid in missing}
+        seen_today = []
+
+        self.stats.count('sync.jobs', len(jobs))
+        with ThreadPoolExecutor(min(self.workers, len(jobs))) as pool, \
+                self.stats.timer('sync.fetch'):
+            days = pool.map(lambda job: self.request_day_from_utm5(job[1],
+                job[2], job[0]), jobs)
+            for (cid, date, traffic_type), rows in zip(jobs, days):
+                if date == today:
+                    changed = self.today_changes(cid, traffic_type, today, rows)
+                    self.stats.count('sync.today_unchanged', len(rows) - len(changed))
+                    rows = changed
+                    seen_today.append((cid, traffic_type, rows))
+                data[cid][traffic_type].extend(rows)
+
+        updates = {}
+        for cid, rows in data.items():
+            fixed = [date for date in missing[cid] if date != today]
+            if fixed or any(rows.values()):
+                updates[cid] = rows, fixed
+        if updates:
+            self.db.update_contracts(updates)
+
+        for cid, traffic_type, rows in seen_today:
+            seen = self.today_seen[str(cid), traffic_type][1]
+            seen.update(((row[0], row[2]), row[3]) for row in rows)
+
+    def backfill(self, start, end, cids=None, traffic_types=("LLTRAF_INET",),
+            batch=256, progress=None):
+        """
+            Sync all missing days from start to end dates inclusive of
+            specified (all by default) contracts, oldest first, committing
+            every `batch` contract days in a single transaction.
+
+            Fixed days are the checkpoint: an interrupted backfill loses at
+            most the current batch and resumes when run again.
+
+            @param progress: called after every batch with number of synced
+                        and all missing contract days and elapsed seconds
+            @return: (number of synced contract days, elapsed seconds)
+        """
+        if cids is None:
+            cids = list(self.contracts)
+
+        end = min(end, datetime.today().date())
+        if end < start:
+            return 0, 0.0
+        jobs = sorted((date, str(cid)) for cid in cids
+                for date in self.db.missing_dates(cid, start, end, traffic_types))
+
+        started = time.perf_counter()
+        for i in range(0, len(jobs), batch):
+            missing = {}
+            for date, cid in jobs[i:i + batch]:
+                missing.setdefault(cid, []).append(date)
+            self.sync_days(missing, traffic_types)
+            if progress:
+                progress(min(i + batch, len(jobs)), len(jobs),
+                        time.perf_counter() - started)
+
+        return len(jobs), time.perf_counter() - started
+
+    def today_changes(self, cid, traffic_type, today, rows):
+        """
+            Return only rows of today's data, which are new or have changed
+            since the last sync (usually the last hour or two).
+        """
+        key = str(cid), traffic_type
+        if key not in self.today_seen or self.today_seen[key][0] != today:
+            self.today_seen[key] = today, {}
+        seen = self.today_seen[key][1]
+        return [row for row in rows if seen.get((row[0], row[2])) != row[3]]
+
+    def month_range(self, year, month):
+        """Return first and last (but not future) dates of specified month."""
         today = datetime.today().date()
         date = datetime(year, month, 1).date()
 
@@ -217,36 +1189,68 @@ class UTM5Client(object):
             raise Exception(date.strftime(
               "Нельзя узнать свою статистику за %B %Y"))
 
-        daytime_amounts = [0, 0]
-        full_amounts = [0, 0]
+        end = min(datetime(year + month // 12, month % 12 + 1, 1).date() -
+                timedelta(days=1), today)
 
-        while date.month == month:
+        return date, end
 
-            if not self.db.date_is_fixed(self.cid, date):
-                data = self.request_day_from_utm5(date)
-                self.db.update_data(self.cid, data)
-                if date != today:
-                    self.db.fix_date(self.cid, date)
+    def get_month_traffic(self, year=None, month=None,
+        traffic_type="LLTRAF_INET", cid=None, sync_types=None):
 
-            date_daytime_amounts = self.db.get_amounts(self.cid, date,
-                self.hours)
-            daytime_amounts[0] += date_daytime_amounts[0]
-            daytime_amounts[1] += date_daytime_amounts[1]
+        if cid is None:
+            cid = self.cid
 
-            date_full_amounts = self.db.get_amounts(self.cid, date,
-                list(range(24)))
-            full_amounts[0] += date_full_amounts[0]
-            full_amounts[1] += date_full_amounts[1]
+        return self.get_contracts_traffic(year, month, traffic_type, [cid],
+                sync_types)[cid]
 
-            if date == today:
-                break
-            else:
-                date += timedelta(days=1)
+    def get_contracts_traffic(self, year=None, month=None,
+        traffic_type="LLTRAF_INET", cids=None, sync_types=None):
+        """
+            Sync specified (all by default) contracts concurrently and return
+            {cid: (daytime_amounts, full_amounts)} of specified traffic type
+            for specified (current by default) month. While UTM5 is
+            unavailable cached traffic is returned at once.
+
+            @param sync_types: traffic types to sync at once, e.g.
+                        TRAFFIC_TYPES, only `traffic_type` by default
+        """
+        if cids is None:
+            cids = list(self.contracts)
+
+        if sync_types is None:
+            sync_types = (traffic_type,)
+
+        today = datetime.today()
+        start, end = self.month_range(today.year if year is None else year,
+                today.month if month is None else month)
+
+        try:
+            self.sync_days({cid: self.db.missing_dates(cid, start, end,
+                sync_types) for cid in cids}, sync_types)
+        except Exception as e:
+            # the failure has opened the breaker or it was open already
+            if not self.http.breaker.is_open:
+                raise
+            logging.warning('%s, using cached traffic' % e)
 
-        return daytime_amounts, full_amounts
+        traffic = {}
+        for cid in cids:
+            daytime_amounts, full_amounts = self.db.get_range_amounts(cid,
+                    start, end, self.hours, traffic_type)
+            traffic[cid] = list(daytime_amounts), list(full_amounts)
+
+        return traffic
+
+    def traffic_cube(self, start, end, traffic_type="LLTRAF_INET", cid=None):
+        """Return TrafficCube of cached traffic from start to end dates."""
+        return TrafficCube(self.db, self.cid if cid is None else cid, start,
+                end, traffic_type)
 
 
 if __name__ == '__main__':
+    from optparse import OptionParser
+    from getpass import getpass
+
     parser = OptionParser(usage='Usage: %prog [options]', version='0.2.0')
     parser.add_option('-u', '--url', dest='url',
             help='адрес системы UTM5',
@@ -269,10 +1273,58 @@ if __name__ == '__main__':
     parser.add_option('-n', '--night', dest='night', metavar='N-M',
             help='ночное время (по умолчанию: %default)',
             default=config['utm5']['hours'])
+    parser.add_option('-j', '--jobs', dest='workers', type='int', metavar='N',
+            help='число одновременных запросов к UTM5 (по умолчанию: %default)',
+            default=int(config['utm5'].get('workers', 4)))
+    parser.add_option('-a', '--all-contracts', action='store_true',
+            dest='all_contracts',
+            help='вывести трафик по всем договорам',
+            default=False)
+    parser.add_option('-t', '--traffic-type', dest='traffic_type',
+            metavar='TYPE', choices=TRAFFIC_TYPES,
+            help='тип трафика: %s (по умолчанию: %%default)' % ', '.join(TRAFFIC_TYPES),
+            default='LLTRAF_INET')
+    parser.add_option('-T', '--all-types', action='store_true',
+            dest='all_types',
+            help='синхронизировать и вывести все типы трафика',
+            default=False)
+    parser.add_option('-N', '--what-if', dest='what_if', metavar='N-M',
+            action='append', default=[],
+            help='посчитать дневной трафик и для другого ночного времени')
+    parser.add_option('-s', '--stats', action='store_true', dest='stats',
+            help='вывести статистику запросов, разбора и базы данных в stderr',
+            default=False)
     parser.add_option('-c', '--ignore-config', action='store_true',
             dest='ignore_cfg',
             help='игнорировать сохраненные логин и пароль',
             default=False)
+    parser.add_option('-S', '--no-sync-service', action='store_true',
+            dest='no_daemon',
+            help='не брать данные у запущенного utm5sync',
+            default=False)
+    parser.add_option('-F', '--from', dest='start', metavar='DD.MM.YYYY',
+            help='загрузить историю трафика начиная с этой даты',
+            default=None)
+    parser.add_option('--to', dest='end', metavar='DD.MM.YYYY',
+            help='загрузить историю трафика по эту дату (по умолчанию: сегодня)',
+            default=None)
+    parser.add_option('-C', '--contract', dest='contracts', metavar='CID',
+            action='append', type='int', default=[],
+            help='загрузить историю только этого договора (можно указать несколько раз)')
+    parser.add_option('--timeout', dest='timeout', type='float', metavar='SEC',
+            help='таймаут запросов к UTM5 (по умолчанию: %default)',
+            default=float(config['utm5'].get('timeout', 30)))
+    parser.add_option('-r', '--rate', dest='rate', type='float', metavar='N',
+            help='не больше N запросов к UTM5 в секунду (по умолчанию: без ограничения)',
+            default=float(config['utm5'].get('rate', 0)))
+    parser.add_option('-E', '--export', dest='export', metavar='FORMAT',
+            choices=tuple(EXPORT_FORMATS),
+            help='выгрузить сохраненный трафик на stdout: %s' % ', '.join(EXPORT_FORMATS),
+            default=None)
+    parser.add_option('-P', '--period', dest='period', metavar='PERIOD',
+            choices=tuple(Storage.periods),
+            help='суммировать выгружаемый трафик по: %s (по умолчанию: %%default)' % ', '.join(Storage.periods),
+            default='hour')
     opt, args = parser.parse_args()
 
     if opt.debug:
@@ -289,46 +1341,125 @@ if __name__ == '__main__':
     if opt.login is None and len(args) == 1:
         opt.login = args[0]
 
-    if opt.ignore_cfg == False and opt.login is None:
-        opt.login = config['utm5']['login']
-        opt.passwd = config['utm5']['passwd']
+    traffic_types = TRAFFIC_TYPES if opt.all_types else (opt.traffic_type,)
+    dayhours = daytime_hours(opt.night)
 
-    if opt.login is None:
-        opt.login = input('Login: ')
+    stats = Stats()
+    if opt.stats:
+        import atexit
+        atexit.register(stats.report, sys.stderr)
 
-    if opt.passwd is None:
-        opt.passwd = getpass()
+    try:
+        start = datetime.strptime(opt.start, '%d.%m.%Y').date() if opt.start \
+                else None
+        end = datetime.strptime(opt.end, '%d.%m.%Y').date() if opt.end \
+                else datetime.today().date()
+    except ValueError:
+        parser.error('дата должна быть в формате ДД.ММ.ГГГГ')
+    if start is not None and end < start:
+        parser.error('начальная дата позже конечной')
 
-    begin, end = [ int(i) for i in opt.night.split('-') ]
+    if opt.export:
+        # cached data only, no need to authenticate
+        rows = Storage(opt.workdir, stats=stats).export(start or from_epoch_day(0), end,
+                opt.contracts, traffic_types, opt.period)
+        if opt.export == 'columns':
+            EXPORT_FORMATS[opt.export](rows, sys.stdout.buffer)
+        else:
+            EXPORT_FORMATS[opt.export](rows, sys.stdout)
+        sys.exit()
 
-    if begin < end:
-        night_hours = list(range(begin, end))
+    synced = None
+    if not opt.no_daemon and not opt.ignore_cfg and opt.login is None and \
+            start is None:
+        # current traffic from utm5sync, if it is running
+        from utm5sync import month_totals
+        synced = month_totals(opt.workdir, opt.url, config['utm5']['login'])
+        if synced and not all(traffic_type in contract['types']
+                for contract in synced[1].values()
+                for traffic_type in traffic_types):
+            synced = None
+
+    if synced:
+        cid, contracts = synced
+        names = {cid: contract['name'] for cid, contract in contracts.items()}
+        cids = list(contracts) if opt.all_contracts else [cid]
+
+        def hour_amounts(cid, traffic_type):
+            return contracts[cid]['types'][traffic_type]
     else:
-        night_hours = list(range(0, end) + range(begin, 24))
+        if opt.ignore_cfg == False and opt.login is None:
+            opt.login = config['utm5']['login']
+            opt.passwd = config['utm5']['passwd']
 
-    dayhours = list(set(range(24)) - set(night_hours))
+        if opt.login is None:
+            opt.login = input('Login: ')
 
-    if not os.path.exists(opt.workdir):
-        os.mkdir(opt.workdir)
+        if opt.passwd is None:
+            opt.passwd = getpass()
 
-    client = UTM5Client(opt.url, dayhours, opt.workdir)
+        if not os.path.exists(opt.workdir):
+            os.mkdir(opt.workdir)
 
-    try:
-        client.auth(opt.login, opt.passwd)
-    except Exception as e:
-        sys.exit(1)
+        client = UTM5Client(opt.url, dayhours, opt.workdir, workers=opt.workers,
+                timeout=opt.timeout, rate=opt.rate, stats=stats)
 
-    if config['utm5']['login'] != opt.login or \
-            config['utm5']['passwd'] != opt.passwd:
-        config['utm5']['login'] = opt.login
-        config['utm5']['passwd'] = opt.passwd
-        save_config()
+        try:
+            if opt.ignore_cfg:
+                client.auth(opt.login, opt.passwd)
+            else:
+                client.start_session(opt.login, opt.passwd)
+        except Exception as e:
+            sys.exit(1)
 
-    daytime, full = client.get_month_traffic()
+        if config['utm5']['login'] != opt.login or \
+                config['utm5']['passwd'] != opt.passwd:
+            config['utm5']['login'] = opt.login
+            config['utm5']['passwd'] = opt.passwd
+            save_config()
+
+        if start is not None:
+            cids = [ str(cid) for cid in opt.contracts ]
+            unknown = [ cid for cid in cids if cid not in client.contracts ]
+            if unknown:
+                parser.error('нет договоров %s у этого логина' % ', '.join(unknown))
+
+            def progress(done, total, elapsed):
+                sys.stderr.write('\r%d/%d days, %.1f days/s' % (done, total,
+                    done / elapsed if elapsed else 0))
+
+            done, elapsed = client.backfill(start, end, cids or
+                    (None if opt.all_contracts else [client.cid]),
+                    traffic_types, progress=progress)
+            sys.stderr.write('\n' if done else '')
+            sys.stdout.write('Synced %d days in %.1f s (%.1f days/s)\n' % (
+                done, elapsed, done / elapsed if elapsed else 0))
+            sys.exit()
+
+        names = {cid: contract['name'] for cid, contract in client.contracts.items()}
+        cids = list(client.contracts) if opt.all_contracts else [client.cid]
+        client.get_contracts_traffic(traffic_type=traffic_types[0], cids=cids,
+                sync_types=traffic_types)
+        start, end = client.month_range(datetime.today().year,
+                datetime.today().month)
+
+        def hour_amounts(cid, traffic_type):
+            return client.traffic_cube(start, end, traffic_type, cid).hour_amounts()
 
     def hum(size):
         return '%.2f MiB' % (float(size)/(2**20),)
 
-    sys.stdout.write("Daytime (in/out):\t%s / %s\n" % (hum(daytime[0]), hum(daytime[1])))
-    sys.stdout.write("Full (in/out):\t\t%s / %s\n" % (hum(full[0]), hum(full[1])))
-
+    for cid in cids:
+        if opt.all_contracts:
+            sys.stdout.write("Contract %s (%s):\n" % (cid, names[cid]))
+        for traffic_type in traffic_types:
+            amounts = hour_amounts(cid, traffic_type)
+            daytime, full = split_amounts(amounts, dayhours)
+            if opt.all_types:
+                sys.stdout.write("%s:\n" % traffic_type)
+            sys.stdout.write("Daytime (in/out):\t%s / %s\n" % (hum(daytime[0]), hum(daytime[1])))
+            sys.stdout.write("Full (in/out):\t\t%s / %s\n" % (hum(full[0]), hum(full[1])))
+            for night in opt.what_if:
+                daytime, full = split_amounts(amounts, daytime_hours(night))
+                sys.stdout.write("Daytime if night is %s:\t%s / %s\n" % (
+                    night, hum(daytime[0]), hum(daytime[1])))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Local stand-in for the UTM5 client area, for benchmarks and debugging
+# without hitting the real billing server.
+
+__all__ = [ 'UTM5Stub' ]
+
+import re, time, random, threading, gzip, zlib, logging
+from datetime import datetime
+from optparse import OptionParser
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class UTM5StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    contract_row = ('<TR><TD ALIGN=CENTER>&nbsp;<A HREF="?FORMNAME=IP_CONTRACT_INFO'
+        '&SID={sid}&CONTR_ID={cid}&NLS=WR" TITLE="Посмотреть данные по договору" '
+        'target="_self" method="post">{name}</A>\n&nbsp;<TD ALIGN=CENTER>&nbsp;'
+        '{client}&nbsp;<TD ALIGN=RIGHT>&nbsp;{balance}.00&nbsp;<TD ALIGN=RIGHT>'
+        '&nbsp;0.00&nbsp;\n')
+    traffic_row = ('<TR><TD BGCOLOR=#B0B0B0>{n}<TD ALIGN=LEFT>&nbsp;{date} '
+        '{hour:02}:00:00&nbsp;<TD ALIGN=LEFT>&nbsp;{login}&nbsp;<TD ALIGN=CENTER>'
+        '&nbsp;{direction}&nbsp;<TD ALIGN=LEFT>&nbsp;{traffic}&nbsp;'
+        '<TD ALIGN=CENTER>&nbsp;{amount}&nbsp;\n')
+    login_form = ('<FORM METHOD=POST><INPUT TYPE=TEXT NAME="USERNAME">'
+        '<INPUT TYPE=PASSWORD NAME="PASSWORD"></FORM>')
+    traffic_names = {
+        'LLTRAF_INET': 'Интернет',
+        'LLTRAF_MM': 'Мультимедиа',
+        'LLTRAF_LOC': 'Локальный',
+    }
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_POST(self):
+        stub = self.server
+        arrived = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        form = {k: v[0] for k, v in parse_qs(body.decode('ascii'),
+            encoding='cp1251').items()}
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        with stub.lock:
+            stub.requests += 1
+            if stub.first_request is None:
+                stub.first_request = arrived
+            failed = stub.random.random() < stub.error_rate
+
+        if failed:
+            return self.reply(500, b'Internal Server Error')
+
+        formname = form.get('FORMNAME')
+        if formname == 'IP_CONTRACTS':
+            page = self.contracts_page(form)
+        elif formname == 'LL_TRAFFIC2':
+            page = self.traffic_page(form)
+        else:
+            return self.reply(404, b'Not Found')
+
+        self.reply(200, ('<HTML><BODY><TABLE>' + page +
+            '</TABLE></BODY></HTML>').encode('cp1251'))
+
+    def reply(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=windows-1251')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+
+    def contracts_page(self, form):
+        stub = self.server
+        login = form.get('USERNAME') or ''
+        if not login or not form.get('PASSWORD'):
+            return self.login_form
+
+        with stub.lock:
+            stub.session += 1
+            sid = 'S%dX%d' % (stub.session, stub.random.randrange(10**9))
+            stub.sessions[sid] = login
+
+        return ''.join(self.contract_row.format(sid=sid, cid=cid,
+            name='contract%d' % cid, client='Абонент %d' % cid,
+            balance=cid % 1000) for cid in stub.contract_ids)
+
+    def traffic_page(self, form):
+        stub = self.server
+        with stub.lock:
+            login = stub.sessions.get(form.get('SID'))
+        if login is None or int(form.get('CONTRACTID', 0)) not in stub.contract_ids:
+            return self.login_form
+
+        cid = int(form['CONTRACTID'])
+        month, year = [ int(i) for i in form['MONTH'].split('.') ]
+        day = int(form['DAY'])
+        traffic_type = form.get('SRV', 'LLTRAF_INET')
+
+        rows = []
+        now = datetime.now()
+        for hour in range(stub.hours):
+            if datetime(year, month, day, hour) > now:
+                break
+            for direction in '<>':
+                rows.append(self.traffic_row.format(n=len(rows) + 1,
+                    date='%02d.%02d.%02d' % (day, month, year % 100),
+                    hour=hour, login=re.sub(r'\W', '_', login) or 'user',
+                    direction=direction,
+                    traffic=self.traffic_names.get(traffic_type, traffic_type),
+                    amount=stub.amount(cid, traffic_type, year, month, day,
+                        hour, direction)))
+
+        return ''.join(rows)
+
+
+class UTM5Stub(ThreadingHTTPServer):
+    """
+        HTTP server mimicking `!w3_p_main.showform` of the UTM5 client area
+        for IP_CONTRACTS and LL_TRAFFIC2 forms.
+
+        Any non-empty login and password are accepted. Traffic amounts are
+        deterministic, so repeated syncs return the same data.
+
+        @param contracts: number of contracts of every login
+        @param hours: number of hours with traffic per day (up to 24, two
+                      rows per hour)
+        @param latency: delay of every response in seconds
+        @param error_rate: share of requests answered with HTTP 500
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), contracts=1, hours=24,
+            latency=0, error_rate=0, seed=0):
+        super(UTM5Stub, self).__init__(address, UTM5StubHandler)
+        self.contract_ids = [ 1001 + i for i in range(contracts) ]
+        self.hours = min(hours, 24)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.session = 0
+        self.requests = 0
+        self.first_request = None
+        self.bytes_sent = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/utm5' % self.server_address[:2]
+
+    def amount(self, cid, traffic_type, year, month, day, hour, direction):
+        key = '%d %s %d.%d.%d %d %s' % (cid, traffic_type, day, month, year,
+                hour, direction)
+        return (zlib.crc32(key.encode()) & 0xfffff) * (4 if direction == '<' else 1)
+
+    def expire_sessions(self):
+        """Forget all session IDs, as UTM5 does after a timeout."""
+        with self.lock:
+            self.sessions.clear()
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-b', '--bind', dest='host', default='127.0.0.1',
+            help='адрес (по умолчанию: %default)')
+    parser.add_option('-P', '--port', dest='port', type='int', default=8080,
+            help='порт (по умолчанию: %default)')
+    parser.add_option('-c', '--contracts', dest='contracts', type='int',
+            default=1, help='число договоров (по умолчанию: %default)')
+    parser.add_option('-H', '--hours', dest='hours', type='int', default=24,
+            help='число часов с трафиком в сутках (по умолчанию: %default)')
+    parser.add_option('-L', '--latency', dest='latency', type='float',
+            default=0, help='задержка ответа в секундах (по умолчанию: %default)')
+    parser.add_option('-e', '--error-rate', dest='error_rate', type='float',
+            default=0, help='доля ответов с ошибкой (по умолчанию: %default)')
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+            help='вывод отладочных сообщений', default=False)
+    opt, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if opt.debug else logging.INFO,
+            format="%(message)s")
+
+    stub = UTM5Stub((opt.host, opt.port), opt.contracts, opt.hours,
+            opt.latency, opt.error_rate)
+    logging.info('Serving UTM5 stub at %s' % stub.url)
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        stub.server_close()
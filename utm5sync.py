@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Background sync of UTM5 traffic. Keeps the cache warm on an hourly
+# schedule and serves traffic of the current month over a Unix socket, so
+# the tray application and the command line client answer from memory.
+
+__all__ = [ 'SyncService', 'query', 'month_totals', 'socket_path' ]
+
+import os, sys, json, time, socket, signal, logging, threading
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+from settings import config, DEFAULT_WORKDIR
+from utm5client import UTM5Client, TRAFFIC_TYPES
+
+
+def socket_path(workdir=DEFAULT_WORKDIR):
+    return os.path.join(workdir, 'sync.sock')
+
+
+def query(command='totals', workdir=DEFAULT_WORKDIR, timeout=1):
+    """Send command to the sync service and return its decoded reply, or
+    None if the service is not running."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path(workdir))
+            sock.sendall(command.encode('ascii') + b'\n')
+            with sock.makefile('rb') as f:
+                reply = f.readline()
+    except OSError:
+        return None
+
+    try:
+        return json.loads(reply.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def month_totals(workdir=DEFAULT_WORKDIR, url=None, login=None, max_age=7200):
+    """
+        Return (cid, {cid: {'name': name, 'types': {traffic_type:
+        hour_amounts}}}) of the current month from the sync service, where
+        cid is the current contract and hour_amounts is list of 24 (in, out)
+        amounts per hour of day.
+
+        Return None if the service is not running, has not synced yet, its
+        data is older than `max_age` seconds or belongs to another month,
+        url or login.
+    """
+    totals = query('totals', workdir)
+    if not totals or not totals.get('updated'):
+        return None
+
+    if time.time() - totals['updated'] > max_age or \
+            totals['month'] != datetime.today().strftime('%Y-%m') or \
+            url is not None and totals['url'] != url.strip('/') or \
+            login is not None and totals['login'] != login:
+        return None
+
+    return totals['cid'], totals['contracts']
+
+
+class SyncRequestHandler(StreamRequestHandler):
+    """
+        One command per line:
+
+            totals - JSON with traffic of the current month
+            stats  - JSON with Stats.snapshot() of the client
+            sync   - start sync now
+    """
+
+    def handle(self):
+        service = self.server.service
+        command = self.rfile.readline(64).strip().decode('ascii', 'replace')
+
+        if command == 'totals':
+            self.wfile.write(service.reply)
+        elif command == 'stats':
+            self.wfile.write(json.dumps(service.client.stats.snapshot())
+                    .encode('utf-8') + b'\n')
+        elif command == 'sync':
+            service.wakeup.set()
+            self.wfile.write(b'{"ok": true}\n')
+        else:
+            self.wfile.write(b'{"error": "unknown command"}\n')
+
+
+class SyncService(object):
+    """
+        Syncs all contracts of `client` at startup and then `delay` seconds
+        past every hour, when UTM5 has counted the last hour. Failed syncs
+        are retried in `retry` seconds.
+
+        Traffic of the current month is kept as a ready JSON reply, so
+        readers get it without touching SQLite or UTM5.
+    """
+
+    def __init__(self, client, login, traffic_types=TRAFFIC_TYPES, delay=300,
+            retry=300):
+        self.client = client
+        self.login = login
+        self.traffic_types = traffic_types
+        self.delay = delay
+        self.retry = retry
+        self.wakeup = threading.Event()
+        self.reply = b'{"updated": null}\n'
+
+    def next_run(self, now):
+        """Return time of the next sync after `now`."""
+        run = now.replace(minute=0, second=0, microsecond=0) + \
+                timedelta(seconds=self.delay)
+        while run <= now:
+            run += timedelta(hours=1)
+        return run
+
+    def sync(self):
+        today = datetime.today()
+        start, end = self.client.month_range(today.year, today.month)
+
+        self.client.get_contracts_traffic(today.year, today.month,
+                self.traffic_types[0], sync_types=self.traffic_types)
+
+        contracts = {}
+        for cid, contract in self.client.contracts.items():
+            contracts[cid] = {'name': contract['name'], 'types': {
+                traffic_type: self.client.traffic_cube(start, end,
+                    traffic_type, cid).hour_amounts()
+                for traffic_type in self.traffic_types}}
+
+        self.reply = json.dumps({'updated': time.time(), 'url': self.client.url,
+            'login': self.login, 'cid': self.client.cid,
+            'month': today.strftime('%Y-%m'), 'contracts': contracts}).encode('utf-8') + b'\n'
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+                wait = (self.next_run(datetime.now()) - datetime.now()).total_seconds()
+                logging.info('Synced, next sync in %d s' % wait)
+            except Exception:
+                logging.exception('Sync failed')
+                wait = self.retry
+            self.wakeup.wait(max(wait, 0))
+            self.wakeup.clear()
+
+    def serve(self, path):
+        """Run scheduler thread and serve readers at Unix socket `path`."""
+        if os.path.exists(path):
+            if query('totals', os.path.dirname(path)) is not None:
+                raise Exception('Sync service is already running')
+            os.unlink(path)
+
+        server = ThreadingUnixStreamServer(path, SyncRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        os.chmod(path, 0o600)
+
+        threading.Thread(target=self.run, daemon=True).start()
+        logging.info('Serving at %s' % path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-w', '--workdir', dest='workdir',
+            help='рабочая директория программы',
+            default=DEFAULT_WORKDIR)
+    parser.add_option('-f', '--foreground', action='store_true',
+            dest='foreground',
+            help='не уходить в фон, выводить сообщения в консоль',
+            default=False)
+    parser.add_option('-D', '--delay', dest='delay', type='int', metavar='SEC',
+            help='синхронизация через SEC секунд после начала часа (по умолчанию: %default)',
+            default=300)
+    parser.add_option('-T', '--all-types', action='store_true',
+            dest='all_types',
+            help='синхронизировать все типы трафика',
+            default=False)
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+            help='вывод отладочных сообщений',
+            default=False)
+    opt, args = parser.parse_args()
+
+    login, passwd = config['utm5']['login'], config['utm5']['passwd']
+    if not login or not passwd:
+        sys.exit('Login and password are not set in config')
+
+    workdir = os.path.abspath(opt.workdir)
+    if not os.path.exists(workdir):
+        os.mkdir(workdir)
+
+    def run():
+        logging.basicConfig(level=logging.DEBUG if opt.debug else logging.INFO,
+                format="%(asctime)s %(message)s", filename=None if
+                opt.foreground else os.path.join(workdir, 'sync.log'))
+
+        # SQLite and HTTP connections must not cross the fork
+        client = UTM5Client(hours=config['utm5']['hours'], workdir=workdir)
+        try:
+            client.start_session(login, passwd)
+        except Exception:
+            logging.exception('Authentication failed')
+            sys.exit(1)
+        SyncService(client, login, TRAFFIC_TYPES if opt.all_types else
+                ('LLTRAF_INET',), opt.delay).serve(socket_path(workdir))
+
+    if opt.foreground:
+        # remove the socket on kill as DaemonContext does
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        from daemon import DaemonContext
+        with DaemonContext(working_directory=workdir, umask=0o077):
+            run()